@@ -0,0 +1,211 @@
+import gzip
+from datetime import datetime
+from flask import Blueprint, request, jsonify, abort
+from app import db, paginate, gather, count_shows, upcoming_shows, past_shows, venue_shows, artist_shows
+from models import Venue, Artist, Show
+import discovery
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#----------------------------------------------------------------------------#
+# JSON API.
+#----------------------------------------------------------------------------#
+
+# Read-only JSON versions of the listing and detail pages under /api/v1.
+#
+# `fields=name,city` projects the response onto the given fields, and only
+# the columns behind them are selected (the id is always included). Listings
+# are keyset-paginated like the HTML pages: `limit`, and the `next`/`prev`
+# cursors of a response passed back as `after`/`before`. Responses are
+# compressed with brotli or gzip when the client accepts it.
+#
+# /venues/discover and /artists/discover list the venues or artists in all
+# of the `genre` arguments (repeated), and in `city`, `state` and seeking
+# talent/venues (`seeking=1`) when given. Besides the page, they return the
+# `total` number of matches and, per genre, how many of them are also in
+# that genre (`facets`), see discovery.py.
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+def columns_of(model):
+    return {column.key: getattr(model, column.key) for column in model.__table__.columns}
+
+VENUE_FIELDS = columns_of(Venue)
+ARTIST_FIELDS = columns_of(Artist)
+SHOW_FIELDS = {
+    **columns_of(Show),
+    'venue_name': Venue.name.label('venue_name'),
+    'venue_image_link': Venue.image_link.label('venue_image_link'),
+    'artist_name': Artist.name.label('artist_name'),
+    'artist_image_link': Artist.image_link.label('artist_image_link'),
+}
+
+# detail fields that are not columns of the entity itself
+SHOW_LIST_FIELDS = ('upcoming_shows', 'past_shows', 'upcoming_shows_count', 'past_shows_count')
+
+def requested_fields(available, default, extra=()):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(default)
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in available and field not in extra]
+    if unknown:
+        abort(400, f'Unknown fields: {", ".join(unknown)}')
+    return fields
+
+def serialize(row, fields):
+    data = {}
+    for field in fields:
+        value = row[field]
+        data[field] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+def listing(query_for, available, default, order, types, **extra):
+    # the pagination columns are selected too, but only id and the requested
+    # fields are returned; extra items are added to the response as is
+    fields = list(dict.fromkeys(['id', *requested_fields(available, default)]))
+    selected = list(dict.fromkeys([*fields, *[column.key for column in order]]))
+    page = paginate(query_for(selected), columns=order, types=types)
+
+    return jsonify(data=[serialize(row._mapping, fields) for row in page['rows']],
+                   next=page['next'],
+                   prev=page['prev'],
+                   **extra)
+
+def detail(model, available, shows_query, entity_id):
+    fields = requested_fields(available, list(available) + list(SHOW_LIST_FIELDS), SHOW_LIST_FIELDS)
+    columns = [available[field] for field in dict.fromkeys(['id', *fields]) if field in available]
+
+    # the entity and the requested show lists are independent queries, run
+    # concurrently with PARALLEL_QUERIES
+    now = datetime.now()
+    owner_column = Show.venue_id if model is Venue else Show.artist_id
+    queries = {'row': lambda: db.session.query(*columns).filter(model.id == entity_id).first()}
+    if 'upcoming_shows_count' in fields or 'past_shows_count' in fields:
+        queries['counts'] = lambda: count_shows(owner_column, entity_id, now)
+    if 'upcoming_shows' in fields:
+        queries['upcoming'] = lambda: upcoming_shows(shows_query(entity_id), now)
+    if 'past_shows' in fields:
+        queries['past'] = lambda: past_shows(shows_query(entity_id), now)
+    results = dict(zip(queries, gather(*queries.values())))
+
+    if results['row'] is None:
+        abort(404)
+    data = serialize(results['row']._mapping, [column.key for column in columns])
+
+    if 'counts' in results:
+        data['upcoming_shows_count'], data['past_shows_count'] = results['counts']
+    if 'upcoming' in results:
+        data['upcoming_shows'] = [serialize(show._mapping, show._fields)
+                                  for show in results['upcoming']]
+    if 'past' in results:
+        # the most recent past shows; `past_shows_next` is the cursor for the
+        # HTML "load more" endpoint
+        past, data['past_shows_next'] = results['past']
+        data['past_shows'] = [serialize(show._mapping, show._fields) for show in past]
+    return jsonify(data)
+
+def discover(model, available, default, order, types):
+    filters = {
+        'genres': list(dict.fromkeys(request.args.getlist('genre'))),
+        'city': request.args.get('city'),
+        'state': request.args.get('state'),
+        'seeking': request.args.get('seeking') in ('1', 'true'),
+    }
+    total, facets = discovery.facets(model, **filters)
+    return listing(lambda fields: discovery.filtered(
+                       model, db.session.query(*[available[field] for field in fields]), **filters),
+                   available, default, order, types,
+                   total=total,
+                   facets=dict(sorted(facets.items())))
+
+#  Venues
+#  ----------------------------------------------------------------
+
+@api.route('/venues')
+def venues():
+    return listing(lambda fields: db.session.query(*[VENUE_FIELDS[field] for field in fields]),
+                   VENUE_FIELDS,
+                   default=('id', 'name', 'city', 'state'),
+                   order=(Venue.id,),
+                   types=(int,))
+
+@api.route('/venues/<int:venue_id>')
+def venue(venue_id):
+    return detail(Venue, VENUE_FIELDS, venue_shows, venue_id)
+
+@api.route('/venues/discover')
+def discover_venues():
+    return discover(Venue, VENUE_FIELDS, ('id', 'name', 'city', 'state', 'genres'),
+                    order=(Venue.id,), types=(int,))
+
+#  Artists
+#  ----------------------------------------------------------------
+
+@api.route('/artists')
+def artists():
+    return listing(lambda fields: db.session.query(*[ARTIST_FIELDS[field] for field in fields]),
+                   ARTIST_FIELDS,
+                   default=('id', 'name'),
+                   order=(Artist.name, Artist.id),
+                   types=(str, int))
+
+@api.route('/artists/<int:artist_id>')
+def artist(artist_id):
+    return detail(Artist, ARTIST_FIELDS, artist_shows, artist_id)
+
+@api.route('/artists/discover')
+def discover_artists():
+    return discover(Artist, ARTIST_FIELDS, ('id', 'name', 'city', 'state', 'genres'),
+                    order=(Artist.name, Artist.id), types=(str, int))
+
+#  Shows
+#  ----------------------------------------------------------------
+
+def shows_query(fields):
+    # the venue and artist are joined whatever the fields, which leaves out
+    # the shows of deleted ones until they are purged (see deletion.py)
+    return db.session.query(*[SHOW_FIELDS[field] for field in fields]) \
+        .select_from(Show) \
+        .join(Venue, Show.venue_id == Venue.id) \
+        .join(Artist, Show.artist_id == Artist.id)
+
+@api.route('/shows')
+def shows():
+    return listing(shows_query,
+                   SHOW_FIELDS,
+                   default=('venue_id', 'venue_name', 'artist_id', 'artist_name',
+                            'artist_image_link', 'start_time'),
+                   order=(Show.start_time, Show.id),
+                   types=(datetime, int))
+
+#  Errors and compression
+#  ----------------------------------------------------------------
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def api_error(error):
+    return jsonify(error=error.description), error.code
+
+@api.after_request
+def compress(response):
+    if response.direct_passthrough or response.status_code != 200 \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    body = response.get_data()
+    if len(body) < 500:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
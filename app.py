@@ -2,44 +2,289 @@
 # Imports
 #----------------------------------------------------------------------------#
 
+import os
 import json
-import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import wraps
+from itertools import groupby
+from flask import Flask, render_template, stream_template, request, Response, flash, redirect, url_for, abort, make_response, g, session, get_flashed_messages
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 import logging
 from logging import Formatter, FileHandler
 from flask_wtf import FlaskForm
+from jinja2 import FileSystemBytecodeCache
 from forms import *
+from pool_metrics import InstrumentedQueuePool, pool_stats
+import replicas
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
 
 app = Flask(__name__)
-moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+if app.config['TEMPLATE_BYTECODE_CACHE_DIR']:
+    # must be set before the Jinja environment is first used
+    os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE_DIR'], exist_ok=True)
+    app.jinja_options = {**app.jinja_options,
+                         'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE_DIR'])}
+moment = Moment(app)
+# time connection checkouts, see pool_metrics.py
+app.config['SQLALCHEMY_ENGINE_OPTIONS'].setdefault('poolclass', InstrumentedQueuePool)
+# GET requests read from replicas when there are, see replicas.py
+db = SQLAlchemy(app, session_options={'class_': replicas.RoutingSession})
+replicas.init_app(app, db)
 migrate = Migrate(app, db)
 
 # TODO: connect to a local postgresql database
 
 from models import *
+import search
+import discovery
+import matching
+import counters
+import bookings
+import cache
+import jobs
+import deletion
+import formatting
+import assets
+import images
+import profiler
+import commands
 
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mm a"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mm a"
-  return babel.dates.format_datetime(date, format, locale='en')
+# see formatting.py
+app.jinja_env.filters['datetime'] = formatting.format_datetime
+
+#----------------------------------------------------------------------------#
+# Pagination.
+#----------------------------------------------------------------------------#
+
+# Listings are paginated with keyset (seek) cursors rather than OFFSET so that
+# every page costs the same index range scan no matter how deep it is. A
+# cursor is the sort key of the first/last row of a page, encoded opaquely.
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, types):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [datetime.fromisoformat(value) if type_ is datetime else type_(value)
+                for type_, value in zip(types, values, strict=True)]
+    except (ValueError, TypeError):
+        abort(400)
+
+def page_size():
+    limit = request.args.get('limit', app.config['PAGE_SIZE'], type=int)
+    return max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+def paginate(query, columns, types):
+    # query must already select the columns it is paginated on, as attributes
+    # named like the columns, so the cursors can be read back off the rows
+    limit = page_size()
+    key = db.tuple_(*columns)
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    if before:
+        rows = query.filter(key < db.tuple_(*decode_cursor(before, types))) \
+            .order_by(*[column.desc() for column in columns]) \
+            .limit(limit + 1) \
+            .all()
+        has_prev = len(rows) > limit
+        has_next = True
+        rows = rows[:limit][::-1]
+    else:
+        if after:
+            query = query.filter(key > db.tuple_(*decode_cursor(after, types)))
+        rows = query.order_by(*columns).limit(limit + 1).all()
+        has_prev = after is not None
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+
+    def cursor(row):
+        return encode_cursor([getattr(row, column.key) for column in columns])
+
+    return {
+        'rows': rows,
+        'prev': cursor(rows[0]) if rows and has_prev else None,
+        'next': cursor(rows[-1]) if rows and has_next else None,
+        'limit': limit,
+    }
+
+#----------------------------------------------------------------------------#
+# Queries.
+#----------------------------------------------------------------------------#
+
+# The queries of a detail page do not depend on each other, so with
+# PARALLEL_QUERIES set they run concurrently, each in its own app context
+# and so its own session and connection: the page then waits for the
+# slowest query instead of the sum of them.
+query_executor = ThreadPoolExecutor(app.config['PARALLEL_QUERIES'], thread_name_prefix='query') \
+    if app.config['PARALLEL_QUERIES'] else None
+
+def gather(*calls):
+    # results of the given query functions, in order
+    if query_executor is None:
+        return [call() for call in calls]
+
+    profile = g.get('profile')
+    replica = g.get('replica')
+    def run(call):
+        with app.app_context():
+            # statements count towards the request's profile, see profiler.py
+            g.profile = profile
+            # and read from the database the request reads from
+            g.replica = replica
+            return call()
+    return [future.result() for future in [query_executor.submit(run, call) for call in calls]]
+
+def count_upcoming_shows(model, ids):
+    # {venue or artist id: upcoming show count} for the given ids, read from
+    # the counters maintained by counters.py
+    if not ids:
+        return {}
+    return dict(db.session.query(model.id, model.num_upcoming_shows)
+                .filter(model.id.in_(ids))
+                .all())
+
+def count_shows(owner_column, owner_id, now):
+    # (upcoming, past) show counts of one venue or artist
+    return db.session.query(db.func.count(Show.id).filter(Show.start_time >= now),
+                            db.func.count(Show.id).filter(Show.start_time < now)) \
+        .filter(owner_column == owner_id) \
+        .one()
+
+def upcoming_shows(query, now):
+    return query.filter(Show.start_time >= now) \
+        .order_by(Show.start_time, Show.id) \
+        .all()
+
+def past_shows(query, now, before=None):
+    # most recent past shows first, at most PAST_SHOWS_LIMIT of them, along
+    # with the cursor the next batch starts from (None if there is no more)
+    limit = app.config['PAST_SHOWS_LIMIT']
+    query = query.filter(Show.start_time < now)
+    if before:
+        query = query.filter(db.tuple_(Show.start_time, Show.id) < db.tuple_(*before))
+    rows = query.order_by(Show.start_time.desc(), Show.id.desc()) \
+        .limit(limit + 1) \
+        .all()
+
+    more = None
+    if len(rows) > limit:
+        more = encode_cursor([rows[limit - 1].start_time, rows[limit - 1].id])
+    return rows[:limit], more
+
+#----------------------------------------------------------------------------#
+# Conditional requests.
+#----------------------------------------------------------------------------#
+
+# Detail pages carry an ETag and Last-Modified derived from the entity and
+# everything on it that can change: its shows, the other side of each show,
+# and the most recent show to have started (the page moves that show from
+# upcoming to past at that moment). Revalidations are answered with 304
+# from one aggregate query, before the page is looked up or rendered.
+
+def show_validators(owner, owner_column, other, other_column, owner_id):
+    # (etag, last_modified) of a venue or artist page, or None if the
+    # entity does not exist
+    now = datetime.now()
+    # the suggested matches shown on the page, see matching.py
+    match_column = Match.venue_id if owner is Venue else Match.artist_id
+    latest_match = db.select(db.func.max(Match.updated_at)) \
+        .where(match_column == owner_id).scalar_subquery()
+    match_count = db.select(db.func.count()).select_from(Match) \
+        .where(match_column == owner_id).scalar_subquery()
+    row = db.session.query(owner.updated_at,
+                           db.func.max(Show.updated_at),
+                           db.func.max(other.updated_at),
+                           db.func.max(Show.start_time).filter(Show.start_time < now),
+                           latest_match,
+                           db.func.count(Show.id),
+                           match_count) \
+        .outerjoin(Show, owner_column == owner.id) \
+        .outerjoin(other, other_column == other.id) \
+        .filter(owner.id == owner_id) \
+        .group_by(owner.id) \
+        .first()
+    if row is None:
+        return None
+
+    *timestamps, count, matches = row
+    last_modified = max(timestamp for timestamp in timestamps if timestamp is not None)
+    last_modified = last_modified.astimezone(timezone.utc).replace(microsecond=0)
+    # pages differ per locale and timezone as well
+    etag = hashlib.sha1(f'{owner.__tablename__}:{owner_id}:{last_modified.isoformat()}:{count}:'
+                        f'{matches}:{cache.variant_key()}'.encode())
+    return etag.hexdigest(), last_modified
+
+def venue_validators(venue_id):
+    return show_validators(Venue, Show.venue_id, Artist, Show.artist_id, venue_id)
+
+def artist_validators(artist_id):
+    return show_validators(Artist, Show.artist_id, Venue, Show.venue_id, artist_id)
+
+def conditional(validators):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # pages carrying flashed messages must be sent, not revalidated
+            validator = None if '_flashes' in session else validators(**kwargs)
+            if validator is None:
+                return view(**kwargs)
+            etag, last_modified = validator
+
+            if request.if_none_match:
+                fresh = request.if_none_match.contains(etag)
+            else:
+                fresh = request.if_modified_since is not None \
+                    and last_modified <= request.if_modified_since
+
+            response = Response(status=304) if fresh else make_response(view(**kwargs))
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # let browsers and the CDN keep the page but revalidate each use
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+#----------------------------------------------------------------------------#
+# After writes.
+#----------------------------------------------------------------------------#
 
-app.jinja_env.filters['datetime'] = format_datetime
+# What a submission changes besides its own rows (cached pages, resized
+# images, matches) is brought up to date by jobs, see jobs.py, so that the
+# response only waits for the commit.
+
+def after_write(*tags, image_link=None):
+    # the write has committed by now: work that cannot be queued (e.g. Redis
+    # is down) is logged, and the submission still reported as done
+    for later in (lambda: cache.invalidate_later(*tags),
+                  lambda: images.resize_later(image_link),
+                  matching.refresh_later):
+        try:
+            later()
+        except Exception:
+            app.logger.exception('cannot queue the work after a write')
+
+def stream_page(template_name, **context):
+    # the layout reads the flashed messages while the body streams, after the
+    # session cookie has been sent; take them out of the session now
+    get_flashed_messages()
+    return stream_template(template_name, **context)
 
 #----------------------------------------------------------------------------#
 # Controllers.
@@ -54,78 +299,96 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@cache.cached
 def venues():
-  # TODO: replace with real venues data.
-  #       num_upcoming_shows should be aggregated based on number of upcoming shows per venue.
+    cache.tag('venues')
+    # venues with their upcoming show count, ordered so that venues sharing
+    # a city/state are adjacent and can be grouped below
+    rows = db.session.query(Venue.city,
+                            Venue.state,
+                            Venue.id,
+                            Venue.name,
+                            Venue.num_upcoming_shows) \
+        .order_by(Venue.state, Venue.city, Venue.name) \
+        .all()
+
     areas = []
-    
-    venues = Venue.query.all()
-    city_state_pairs = Venue.query.distinct(Venue.city, Venue.state).all()
-    
-    for city_state_pair in city_state_pairs:
-        
-        local_venues = []
-        
-        for venue in venues:
-            if venue.city == city_state_pair.city and venue.state == city_state_pair.state:
-                local_venues.append({
-                    'id': venue.id,
-                    'name' : venue.name,
-                    'num_upcoming_shows' : len([show for show in venue.shows if show.start_time > datetime.now()])
-            })
-                
+
+    for (city, state), local_venues in groupby(rows, key=lambda row: (row[0], row[1])):
         areas.append({
-            'city': city_state_pair.city,
-            'state': city_state_pair.state,
-            'venues' : local_venues
+            'city': city,
+            'state': state,
+            'venues': [{
+                'id': venue_id,
+                'name': name,
+                'num_upcoming_shows': num_upcoming_shows
+            } for _, _, venue_id, name, num_upcoming_shows in local_venues]
         })
-    return render_template('pages/venues.html', areas=areas)
+
+    return stream_page('pages/venues.html', areas=areas)
 
 @app.route('/venues/search', methods=['POST'])
+@replicas.reads
 def search_venues():
     # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
     # seach for Hop should return "The Musical Hop".
     # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
     search_term = request.form.get('search_term', '')
-    venues = Venue.query.filter(Venue.name.ilike(f'%{search_term}%')).all()
+    venues = search.venues(search_term, app.config['SEARCH_RESULT_LIMIT'])
+    upcoming = count_upcoming_shows(Venue, [venue_id for venue_id, _ in venues])
     
     response = {
         'count': len(venues),
-        'data': []
+        'data': [{
+            'id': venue_id,
+            'name': name,
+            'num_upcoming_shows': upcoming.get(venue_id, 0)
+        } for venue_id, name in venues]
     }
-  
-    for venue in venues:
-        response['data'].append({
-            'id': venue.id,
-            'name': venue.name,
-            'num_upcoming_shows' : len([show for show in venue.shows if show.start_time > datetime.now()])
-        })    
 
     return render_template('pages/search_venues.html', 
                            results=response, 
                            search_term=search_term)
 
+def venue_shows(venue_id):
+    # the shows of a venue, with the artist columns projected in the same
+    # query instead of lazy loading show.artist once per show
+    return db.session.query(Show.id,
+                            Show.artist_id,
+                            Artist.name.label('artist_name'),
+                            Artist.image_link.label('artist_image_link'),
+                            Show.start_time) \
+        .join(Artist, Show.artist_id == Artist.id) \
+        .filter(Show.venue_id == venue_id)
+
+def venue_show_data(shows):
+    return [{
+        'artist_id': show.artist_id,
+        'artist_name': show.artist_name,
+        'artist_image_link': show.artist_image_link,
+        'start_time': show.start_time
+    } for show in shows]
+
 @app.route('/venues/<int:venue_id>')
+@conditional(venue_validators)
+@cache.cached
 def show_venue(venue_id):
     # shows the venue page with the given venue_id
-    # TODO: replace with real venue data from the venues table, using venue_id
-    venue = Venue.query.get(venue_id)
-    
-    past_shows = []
-    upcoming_shows = []
+    cache.tag(f'venue:{venue_id}')
     
-    for show in venue.shows:
-        show_data = {
-            'artist_id': show.artist_id,
-            'artist_name': show.artist.name,
-            'artist_image_link': show.artist.image_link,
-            'start_time': show.start_time.strftime("%m/%d/%Y, %H:%M")
-        }
-        
-        if show.start_time < datetime.now():
-            past_shows.append(show_data)            
-        else:
-            upcoming_shows.append(show_data)        
+    # the split around now, the counts and the ordering are all done by the
+    # database; only the upcoming shows and the first batch of past shows
+    # are fetched
+    now = datetime.now()
+    venue, (upcoming_shows_count, past_shows_count), upcoming, (past, more), suggested = gather(
+        lambda: Venue.query.get(venue_id),
+        lambda: count_shows(Show.venue_id, venue_id, now),
+        lambda: upcoming_shows(venue_shows(venue_id), now),
+        lambda: past_shows(venue_shows(venue_id), now),
+        lambda: matching.artists_for(venue_id))
+    if venue is None:
+        abort(404)
+    cache.tag(*[f'artist:{show.artist_id}' for show in upcoming + past])
        
     data = {
         'id': venue.id,
@@ -140,14 +403,31 @@ def show_venue(venue_id):
         'seeking_talent': venue.seeking_talent,
         'seeking_description': venue.seeking_description,
         'image_link': venue.image_link,
-        'past_shows': past_shows,
-        'upcoming_shows': upcoming_shows,
-        'past_shows_count': len(past_shows),
-        'upcoming_shows_count': len(upcoming_shows),
+        'past_shows': venue_show_data(past),
+        'upcoming_shows': venue_show_data(upcoming),
+        'past_shows_count': past_shows_count,
+        'upcoming_shows_count': upcoming_shows_count,
+        'more_past_shows_url': more and url_for('venue_past_shows', venue_id=venue_id, before=more),
+        'suggested_artists': suggested if venue.seeking_talent else [],
     }
    
     return render_template('pages/show_venue.html', venue=data)
 
+@app.route('/venues/<int:venue_id>/past_shows')
+@cache.cached
+def venue_past_shows(venue_id):
+    # "load more" on the venue page: the next batch of past shows as an
+    # HTML fragment
+    if db.session.get(Venue, venue_id) is None:
+        abort(404)
+    before = decode_cursor(request.args.get('before', ''), (datetime, int))
+    past, more = past_shows(venue_shows(venue_id), datetime.now(), before)
+    cache.tag(f'venue:{venue_id}', *[f'artist:{show.artist_id}' for show in past])
+
+    return render_template('pages/venue_past_shows.html',
+                           shows=venue_show_data(past),
+                           more_url=more and url_for('venue_past_shows', venue_id=venue_id, before=more))
+
 #  Create Venue
 #  ----------------------------------------------------------------
 
@@ -175,6 +455,7 @@ def create_venue_submission():
                       image_link = request.form.get('image_link'))
         db.session.add(venue)
         db.session.commit()
+        after_write('venues', image_link=request.form.get('image_link'))
         
         # on successful db insert, flash success
         flash('Venue *' + request.form.get('name') + '* was successfully listed!')        
@@ -190,75 +471,103 @@ def create_venue_submission():
         
     return render_template('pages/home.html')
 
-@app.route('/venues/<venue_id>', methods=['DELETE'])
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
 def delete_venue(venue_id):
-  # TODO: Complete this endpoint for taking a venue_id, and using
-  # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
+    # the venue disappears at once and its shows are deleted in the
+    # background, see deletion.py; the page's Delete button then goes to
+    # the home page
+    try:
+        deleted = deletion.delete('venue', venue_id)
+    except:
+        db.session.rollback()
+        return {'success': False}, 500
+    finally:
+        db.session.close()
+    if not deleted:
+        abort(404)
 
-  # BONUS CHALLENGE: Implement a button to delete a Venue on a Venue Page, have it so that
-  # clicking that button delete it from the db then redirect the user to the homepage
-  return None
+    after_write('venues', 'shows', f'venue:{venue_id}')
+    flash('Venue was successfully deleted!')
+    return {'success': True}
 
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@cache.cached
 def artists():
   # TODO: replace with real data returned from querying the database
     
-    artists = Artist.query.all()
+    cache.tag('artists')
+    page = paginate(db.session.query(Artist.id, Artist.name),
+                    columns=(Artist.name, Artist.id),
+                    types=(str, int))
     
     names = [{
         'id' : artist.id,
         'name' : artist.name,
-    } for artist in artists ]
+    } for artist in page['rows'] ]
         
-    return render_template('pages/artists.html', artists=names)                
+    return stream_page('pages/artists.html', artists=names, page=page)                
 
 @app.route('/artists/search', methods=['POST'])
+@replicas.reads
 def search_artists():
     # TODO: implement search on artists with partial string search. Ensure it is case-insensitive.
     # seach for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
     # search for "band" should return "The Wild Sax Band".
     search_term = request.form.get('search_term', '')
-    artists = Artist.query.filter(Artist.name.ilike(f'%{search_term}%')).all()
+    artists = search.artists(search_term, app.config['SEARCH_RESULT_LIMIT'])
+    upcoming = count_upcoming_shows(Artist, [artist_id for artist_id, _ in artists])
     
     response = {
         'count': len(artists),
-        'data': []
+        'data': [{
+            'id': artist_id,
+            'name': name,
+            'num_upcoming_shows': upcoming.get(artist_id, 0)
+        } for artist_id, name in artists]
     }
-  
-    for artist in artists:
-        response['data'].append({
-            'id': artist.id,
-            'name': artist.name,
-            'num_upcoming_shows' : len([show for show in artist.shows if show.start_time > datetime.now()])
-        })     
     
     return render_template('pages/search_artists.html', 
                            results=response, 
                            search_term=search_term)
 
+def artist_shows(artist_id):
+    # the shows of an artist, with the venue columns projected in the same
+    # query instead of lazy loading show.venue once per show
+    return db.session.query(Show.id,
+                            Show.venue_id,
+                            Venue.name.label('venue_name'),
+                            Venue.image_link.label('venue_image_link'),
+                            Show.start_time) \
+        .join(Venue, Show.venue_id == Venue.id) \
+        .filter(Show.artist_id == artist_id)
+
+def artist_show_data(shows):
+    return [{
+        'venue_id': show.venue_id,
+        'venue_name': show.venue_name,
+        'venue_image_link': show.venue_image_link,
+        'start_time': show.start_time
+    } for show in shows]
+
 @app.route('/artists/<int:artist_id>')
+@conditional(artist_validators)
+@cache.cached
 def show_artist(artist_id):
     # shows the artist page with the given artist_id
-    # TODO: replace with real artist data from the artist table, using artist_id
-    artist = Artist.query.get(artist_id)
-    
-    past_shows = []
-    upcoming_shows = []
+    cache.tag(f'artist:{artist_id}')
     
-    for show in artist.shows:
-        show_data = {
-            'venue_id': show.venue_id,
-            'venue_name': show.venue.name,
-            'venue_image_link': show.venue.image_link,
-            'start_time': show.start_time.strftime("%m/%d/%Y, %H:%M")
-        }
-        
-        if show.start_time < datetime.now():
-            past_shows.append(show_data)            
-        else:
-            upcoming_shows.append(show_data)        
+    now = datetime.now()
+    artist, (upcoming_shows_count, past_shows_count), upcoming, (past, more), suggested = gather(
+        lambda: Artist.query.get(artist_id),
+        lambda: count_shows(Show.artist_id, artist_id, now),
+        lambda: upcoming_shows(artist_shows(artist_id), now),
+        lambda: past_shows(artist_shows(artist_id), now),
+        lambda: matching.venues_for(artist_id))
+    if artist is None:
+        abort(404)
+    cache.tag(*[f'venue:{show.venue_id}' for show in upcoming + past])
        
     data = {
         'id': artist.id,
@@ -272,20 +581,56 @@ def show_artist(artist_id):
         'seeking_venue': artist.seeking_venue,
         'seeking_description': artist.seeking_description,
         'image_link': artist.image_link,
-        'past_shows': past_shows,
-        'upcoming_shows': upcoming_shows,
-        'past_shows_count': len(past_shows),
-        'upcoming_shows_count': len(upcoming_shows),
+        'past_shows': artist_show_data(past),
+        'upcoming_shows': artist_show_data(upcoming),
+        'past_shows_count': past_shows_count,
+        'upcoming_shows_count': upcoming_shows_count,
+        'more_past_shows_url': more and url_for('artist_past_shows', artist_id=artist_id, before=more),
+        'suggested_venues': suggested if artist.seeking_venue else [],
     }    
 
     return render_template('pages/show_artist.html', artist=data)
 
+@app.route('/artists/<int:artist_id>/past_shows')
+@cache.cached
+def artist_past_shows(artist_id):
+    # "load more" on the artist page: the next batch of past shows as an
+    # HTML fragment
+    if db.session.get(Artist, artist_id) is None:
+        abort(404)
+    before = decode_cursor(request.args.get('before', ''), (datetime, int))
+    past, more = past_shows(artist_shows(artist_id), datetime.now(), before)
+    cache.tag(f'artist:{artist_id}', *[f'venue:{show.venue_id}' for show in past])
+
+    return render_template('pages/artist_past_shows.html',
+                           shows=artist_show_data(past),
+                           more_url=more and url_for('artist_past_shows', artist_id=artist_id, before=more))
+
+@app.route('/artists/<int:artist_id>', methods=['DELETE'])
+def delete_artist(artist_id):
+    # as delete_venue
+    try:
+        deleted = deletion.delete('artist', artist_id)
+    except:
+        db.session.rollback()
+        return {'success': False}, 500
+    finally:
+        db.session.close()
+    if not deleted:
+        abort(404)
+
+    after_write('artists', 'shows', f'artist:{artist_id}')
+    flash('Artist was successfully deleted!')
+    return {'success': True}
+
 #  Update
 #  ----------------------------------------------------------------
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
     form = ArtistForm()
     artist = Artist.query.get(artist_id)    
+    if artist is None:
+        abort(404)
 
     # TODO: populate form with fields from artist with ID <artist_id>
     return render_template('forms/edit_artist.html', form=form, artist=artist)
@@ -309,6 +654,7 @@ def edit_artist_submission(artist_id):
         artist.image_link = request.form.get('image_link')
         
         db.session.commit()
+        after_write('artists', f'artist:{artist_id}', image_link=request.form.get('image_link'))
         
         flash('Artist *' + request.form.get('name') + '* was successfully updated!')        
     except:
@@ -324,6 +670,8 @@ def edit_artist_submission(artist_id):
 def edit_venue(venue_id):
     form = VenueForm()
     venue = Venue.query.get(venue_id)
+    if venue is None:
+        abort(404)
 
     # TODO: populate form with values from venue with ID <venue_id>
     return render_template('forms/edit_venue.html', form=form, venue=venue)
@@ -348,6 +696,7 @@ def edit_venue_submission(venue_id):
         venue.image_link = request.form.get('image_link')
 
         db.session.commit()
+        after_write('venues', f'venue:{venue_id}', image_link=request.form.get('image_link'))
         
         flash('Venue *' + request.form.get('name') + '* was successfully updated!')        
     except:
@@ -387,6 +736,7 @@ def create_artist_submission():
         
         db.session.add(artist)
         db.session.commit()
+        after_write('artists', image_link=request.form.get('image_link'))
         
         # on successful db insert, flash success
         flash('Artist *' + request.form.get('name') + '* was successfully listed!')        
@@ -405,21 +755,36 @@ def create_artist_submission():
 #  ----------------------------------------------------------------
 
 @app.route('/shows')
+@cache.cached
 def shows():
   # displays list of shows at /shows
   # TODO: replace with real venues data.
-    shows = Show.query.all()
+    query = db.session.query(Show.id,
+                             Show.venue_id,
+                             Venue.name.label('venue_name'),
+                             Show.artist_id,
+                             Artist.name.label('artist_name'),
+                             Artist.image_link.label('artist_image_link'),
+                             Show.start_time) \
+        .join(Venue, Show.venue_id == Venue.id) \
+        .join(Artist, Show.artist_id == Artist.id)
+    page = paginate(query,
+                    columns=(Show.start_time, Show.id),
+                    types=(datetime, int))
+    cache.tag('shows')
+    for show in page['rows']:
+        cache.tag(f'venue:{show.venue_id}', f'artist:{show.artist_id}')
         
     entries = [{
         'venue_id' : show.venue_id,                
-        'venue_name' : show.venue.name,
+        'venue_name' : show.venue_name,
         'artist_id' : show.artist_id, 
-        'artist_name' : show.artist.name,
-        'artist_image_link' : show.artist.image_link, 
-        'start_time' : show.start_time.strftime("%m/%d/%Y, %H:%M")
-    } for show in shows]
+        'artist_name' : show.artist_name,
+        'artist_image_link' : show.artist_image_link, 
+        'start_time' : show.start_time
+    } for show in page['rows']]
             
-    return render_template('pages/shows.html', shows=entries)   
+    return stream_page('pages/shows.html', shows=entries, page=page)   
 
 @app.route('/shows/create')
 def create_shows():
@@ -430,17 +795,22 @@ def create_shows():
 @app.route('/shows/create', methods=['POST'])
 def create_show_submission():
     # called to create new shows in the db, upon submitting new show listing form
-    # TODO: insert form data as a new Show record in the db, instead
+    # checked and inserted like a batch of one, see bookings.py
 
     try:
-        show = Show(start_time = request.form.get('start_time'),
-                    artist_id = request.form.get('artist_id'), 
-                    venue_id = request.form.get('venue_id'))
-        db.session.add(show)
-        db.session.commit()
+        errors = bookings.book([(None,
+                                 int(request.form.get('artist_id')),
+                                 int(request.form.get('venue_id')),
+                                 datetime.fromisoformat(request.form.get('start_time')))])
+        if errors:
+            flash('Show could not be listed: ' + '; '.join(errors) + '.')
+        else:
+            after_write('venues', 'shows',
+                        f"venue:{request.form.get('venue_id')}",
+                        f"artist:{request.form.get('artist_id')}")
         
-        # on successful db insert, flash success
-        flash('Show was successfully listed!')        
+            # on successful db insert, flash success
+            flash('Show was successfully listed!')        
     except:
         db.session.rollback()      
 
@@ -453,6 +823,70 @@ def create_show_submission():
         
     return render_template('pages/home.html')
 
+@app.route('/shows/create-batch', methods=['GET'])
+def create_show_batch_form():
+    form = ShowBatchForm()
+    return render_template('forms/new_shows.html', form=form, errors=[])
+
+@app.route('/shows/create-batch', methods=['POST'])
+def create_show_batch_submission():
+    # a tour of shows, one per line; either all of them are listed or, if
+    # any line has a problem, none and the form comes back with the errors
+    form = ShowBatchForm()
+    parsed, errors = bookings.parse(request.form.get('shows', ''))
+    try:
+        errors = bookings.book(parsed, errors)
+    except:
+        errors = ['An error occurred. Shows could not be listed.']
+    finally:
+        db.session.close()
+    if errors:
+        return render_template('forms/new_shows.html', form=form, errors=errors)
+
+    after_write('venues', 'shows',
+                *{f'venue:{venue_id}' for _, _, venue_id, _ in parsed},
+                *{f'artist:{artist_id}' for _, artist_id, _, _ in parsed})
+    flash(f'{len(parsed)} shows were successfully listed!')
+    return render_template('pages/home.html')
+
+#  Internal
+#  ----------------------------------------------------------------
+
+def internal_only(view):
+    # operational endpoints are only answered on the loopback interface
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/internal/pool')
+@internal_only
+def internal_pool():
+    return pool_stats(db.engine)
+
+@app.route('/internal/replicas')
+@internal_only
+def internal_replicas():
+    return replicas.status()
+
+@app.route('/internal/jobs')
+@internal_only
+def internal_jobs():
+    return jobs.status()
+
+@app.route('/internal/profile')
+@internal_only
+def internal_profile():
+    return profiler.route_stats()
+
+#  API
+#  ----------------------------------------------------------------
+
+from api import api
+app.register_blueprint(api)
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -472,6 +906,19 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     app.logger.info('errors')
 
+#----------------------------------------------------------------------------#
+# Templates.
+#----------------------------------------------------------------------------#
+
+# Outside debug mode every template is compiled at startup, so that no
+# request pays for compiling one. The listing pages are streamed
+# (stream_page) and reach the client while the rest of the list is
+# still being rendered.
+
+if not app.debug:
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
@@ -0,0 +1,203 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from markupsafe import Markup, escape
+from flask import request, send_from_directory, abort
+from werkzeug.security import safe_join
+from app import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+#----------------------------------------------------------------------------#
+# Static assets.
+#----------------------------------------------------------------------------#
+
+# `flask build-assets` concatenates and minifies the stylesheets and scripts
+# of each bundle below into static/dist, under names carrying a hash of
+# their content (main.3f2a9c1e0b7d.css), along with gzip and brotli copies.
+# Files the stylesheets refer to (fonts, images) are copied there under
+# hashed names too. As a name changes whenever the content does, dist files
+# are served with a year-long immutable Cache-Control and never revalidated.
+#
+# Templates include bundles with {{ stylesheet('main.css') }} and
+# {{ script('main.js') }}. Outside debug mode, once the bundles are built,
+# these link the bundle; otherwise they link each source file as before.
+
+BUNDLES = {
+    'main.css': ['css/bootstrap.min.css',
+                 'css/layout.main.css',
+                 'css/main.css',
+                 'css/main.responsive.css',
+                 'css/main.quickfix.css'],
+    'head.js': ['js/libs/modernizr-2.8.2.min.js',
+                'js/libs/moment.min.js'],
+    'main.js': ['js/libs/bootstrap-3.1.1.min.js',
+                'js/plugins.js',
+                'js/script.js'],
+}
+
+DIST = os.path.join(app.static_folder, 'dist')
+MANIFEST = os.path.join(DIST, 'manifest.json')
+MAX_AGE = 365 * 24 * 60 * 60
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.eot', '.otf', '.map', '.json')
+
+def load_manifest():
+    if not os.path.exists(MANIFEST):
+        return {}
+    with open(MANIFEST) as file:
+        return json.load(file)
+
+manifest = load_manifest()
+
+#  Build
+#  ----------------------------------------------------------------
+
+def minify_css(css):
+    # collapse whitespace and drop comments, leaving strings untouched
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/)', css, flags=re.S)
+    minified = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            if not part.startswith('/*'):
+                minified.append(part)
+            continue
+        part = re.sub(r'\s+', ' ', part)
+        minified.append(re.sub(r' ?([{};,>]) ?', r'\1', part))
+    return ''.join(minified).replace(';}', '}').strip()
+
+def minify_js(js):
+    # only with rjsmin installed; the libraries are shipped minified anyway
+    js = re.sub(r'^//[#@] sourceMappingURL=.*$', '', js, flags=re.M)
+    return rjsmin.jsmin(js) if rjsmin is not None else js
+
+def fingerprint(name, content):
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+
+def write(name, content):
+    with open(os.path.join(DIST, name), 'wb') as file:
+        file.write(content)
+    if name.endswith(COMPRESSIBLE):
+        variants = [('.gz', gzip.compress(content, compresslevel=9))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                with open(os.path.join(DIST, name + suffix), 'wb') as file:
+                    file.write(compressed)
+
+def rewrite_urls(css, source, copied):
+    # url()s relative to the source stylesheet point at hashed copies in
+    # dist, or at their original location when the file is missing
+    def replace(match):
+        url = match.group(2)
+        if re.match(r'^(?:[a-z]+:|/|#)', url):
+            return match.group(0)
+        path, suffix = re.match(r'^([^?#]*)(.*)$', url).groups()
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+        filename = os.path.join(app.static_folder, target)
+        if not os.path.isfile(filename):
+            return f'url("/static/{target}{suffix}")'
+        if target not in copied:
+            with open(filename, 'rb') as file:
+                content = file.read()
+            copied[target] = fingerprint(posixpath.basename(target), content)
+            write(copied[target], content)
+        return f'url("{copied[target]}{suffix}")'
+    return re.sub(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)', replace, css)
+
+def build():
+    # builds every bundle into a fresh static/dist; returns the new manifest
+    global manifest
+    shutil.rmtree(DIST, ignore_errors=True)
+    os.makedirs(DIST)
+
+    built = {}
+    copied = {}
+    for bundle, sources in BUNDLES.items():
+        contents = []
+        for source in sources:
+            with open(os.path.join(app.static_folder, source), encoding='utf-8') as file:
+                text = file.read()
+            if bundle.endswith('.css'):
+                contents.append(minify_css(rewrite_urls(text, source, copied)))
+            else:
+                contents.append(minify_js(text))
+        content = ('\n' if bundle.endswith('.css') else '\n;\n').join(contents).encode()
+        built[bundle] = fingerprint(bundle, content)
+        write(built[bundle], content)
+
+    with open(MANIFEST, 'w') as file:
+        json.dump(built, file, indent=2)
+    manifest = built
+    return built
+
+def transfer_report():
+    # (requests, bytes) sent for all bundles, from the source files and
+    # from the built bundles with the best compression available
+    def best(name):
+        sizes = [os.path.getsize(os.path.join(DIST, name + suffix))
+                 for suffix in ('', '.gz', '.br')
+                 if os.path.exists(os.path.join(DIST, name + suffix))]
+        return min(sizes)
+
+    sources = [source for sources in BUNDLES.values() for source in sources]
+    before = sum(os.path.getsize(os.path.join(app.static_folder, source)) for source in sources)
+    after = sum(best(name) for name in manifest.values())
+    return (len(sources), before), (len(manifest), after)
+
+#  Serving
+#  ----------------------------------------------------------------
+
+def urls(bundle):
+    if manifest and not app.debug:
+        return ['/static/dist/' + manifest[bundle]]
+    return ['/static/' + source for source in BUNDLES[bundle]]
+
+def stylesheet(bundle):
+    return Markup('\n'.join(f'<link type="text/css" rel="stylesheet" href="{escape(url)}" />'
+                            for url in urls(bundle)))
+
+def script(bundle, defer=False):
+    attributes = ' defer' if defer else ''
+    return Markup('\n'.join(f'<script type="text/javascript" src="{escape(url)}"{attributes}></script>'
+                            for url in urls(bundle)))
+
+app.jinja_env.globals.update(stylesheet=stylesheet, script=script)
+
+@app.route('/static/dist/<path:filename>')
+def dist(filename):
+    path = safe_join(DIST, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    # precompressed copies, in order of preference
+    encodings = [('br', '.br'), ('gzip', '.gz')]
+    for encoding, suffix in encodings:
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            response = send_from_directory(DIST, filename + suffix,
+                                           mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(DIST, filename)
+
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,515 @@
+#----------------------------------------------------------------------------#
+# Benchmarks.
+#----------------------------------------------------------------------------#
+
+# Generates a synthetic Fyyur dataset and times every read route of the app
+# against it, in process through the Flask test client, reporting p50/p95
+# latency, SQL statements and peak memory per route. The shows listing is
+# also rendered with --render-rows shows on one page, where template and
+# date formatting costs dominate.
+#
+#   python bench.py --database-url sqlite:///bench.db --shows 100000
+#   python bench.py --database-url postgresql://localhost/fyyur_bench --save-baseline
+#   python bench.py --database-url postgresql://localhost/fyyur_bench
+#
+# The dataset is skewed the way real listings are: a few cities hold most
+# venues, and a few venues and artists hold most shows. It is generated once
+# per database and reused while the requested scale matches.
+#
+# --save-baseline stores the results in benchmarks/, one file per database
+# kind and scale. Later runs at the same scale are compared with it and
+# exit non-zero when a route's p95 latency grows past --tolerance times the
+# baseline or when it issues more statements than before. Write routes are
+# not run, as they would change the dataset between runs.
+#
+# Statement counts must not depend on the amount of data. --scale-check F
+# runs the same routes again, in a process of its own, on a dataset F times
+# larger (in --scale-database-url, by default a second SQLite file next to
+# the first) and fails when a route issues a different number of
+# statements there:
+#
+#   python bench.py --scale-check 4
+#
+# --delete-shows N times deleting a venue with N shows, added for the
+# purpose and gone afterwards, both through the ORM, which loads the shows
+# and deletes them one by one, and as deletion.py does it: the soft delete
+# of the request, then the purge job, where the database deletes the shows.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+CITIES = [
+    ('New York', 'NY'), ('Los Angeles', 'CA'), ('Chicago', 'IL'), ('Houston', 'TX'),
+    ('Phoenix', 'AZ'), ('Philadelphia', 'PA'), ('San Antonio', 'TX'), ('San Diego', 'CA'),
+    ('Dallas', 'TX'), ('San Jose', 'CA'), ('Austin', 'TX'), ('Seattle', 'WA'),
+    ('San Francisco', 'CA'), ('Denver', 'CO'), ('Nashville', 'TN'), ('Boston', 'MA'),
+    ('Portland', 'OR'), ('Las Vegas', 'NV'), ('Detroit', 'MI'), ('Memphis', 'TN'),
+    ('Atlanta', 'GA'), ('Miami', 'FL'), ('New Orleans', 'LA'), ('Minneapolis', 'MN'),
+]
+VENUE_WORDS = ['Hall', 'Lounge', 'Club', 'Theatre', 'Room', 'Garden', 'Cellar', 'Stage', 'Bar', 'Arena']
+ARTIST_WORDS = ['Band', 'Trio', 'Quartet', 'Collective', 'Orchestra', 'Project', 'Ensemble', 'Sound']
+ADJECTIVES = ['Blue', 'Golden', 'Wild', 'Velvet', 'Electric', 'Midnight', 'Silver', 'Crimson',
+              'Musical', 'Lonely', 'Broken', 'Sunny', 'Rusty', 'Hidden', 'Northern', 'Cosmic']
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+def zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+def cumulative(weights):
+    total = 0
+    cum_weights = []
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    return cum_weights
+
+#  Dataset
+#  ----------------------------------------------------------------
+
+def generate(db, models, genres, venues, artists, shows, seed, batch_size=10000):
+    Venue, Artist, Show = models
+    rng = random.Random(seed)
+    city_weights = cumulative(zipf_weights(len(CITIES)))
+    now = datetime.now()
+
+    def entity(i, words):
+        city, state = rng.choices(CITIES, cum_weights=city_weights)[0]
+        return {
+            'id': i,
+            'name': f'{rng.choice(ADJECTIVES)} {rng.choice(words)} {i}',
+            'genres': rng.sample(genres, rng.randint(1, 3)),
+            'city': city,
+            'state': state,
+            'phone': f'555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}',
+            'image_link': f'https://images.example.com/{i}.jpg',
+            'updated_at': now,
+        }
+
+    def insert(model, rows):
+        for start in range(0, len(rows), batch_size):
+            db.session.bulk_insert_mappings(model, rows[start:start + batch_size])
+            db.session.commit()
+
+    insert(Venue, [{**entity(i, VENUE_WORDS),
+                    'address': f'{rng.randint(1, 9999)} Main St',
+                    'seeking_talent': rng.random() < 0.3}
+                   for i in range(1, venues + 1)])
+    insert(Artist, [{**entity(i, ARTIST_WORDS),
+                     'seeking_venue': rng.random() < 0.3}
+                    for i in range(1, artists + 1)])
+
+    # ids are shuffled so that the busiest venues and artists are spread
+    # over the listings instead of being the first rows
+    venue_ids = rng.sample(range(1, venues + 1), venues)
+    artist_ids = rng.sample(range(1, artists + 1), artists)
+    venue_weights = cumulative(zipf_weights(venues))
+    artist_weights = cumulative(zipf_weights(artists))
+    # three years of history and one year of bookings ahead
+    first = now - timedelta(days=3 * 365)
+    span = (4 * 365) * 24 * 60
+
+    for start in range(0, shows, batch_size):
+        count = min(batch_size, shows - start)
+        db.session.bulk_insert_mappings(Show, [{
+            'id': start + i + 1,
+            'venue_id': venue_id,
+            'artist_id': artist_id,
+            'start_time': first + timedelta(minutes=rng.randrange(span)),
+            'updated_at': now,
+        } for i, (venue_id, artist_id) in enumerate(zip(
+            rng.choices(venue_ids, cum_weights=venue_weights, k=count),
+            rng.choices(artist_ids, cum_weights=artist_weights, k=count)))])
+        db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        for table in ('venues', 'artists', 'shows'):
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 1) FROM {table}))"))
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+
+def prepare(db, models, genres, recount, args):
+    Venue, Artist, Show = models
+    scale = (args.venues, args.artists, args.shows)
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    db.create_all()
+
+    current = (Venue.query.count(), Artist.query.count(), Show.query.count())
+    # end the transaction, its locks would block drop_all on PostgreSQL
+    db.session.commit()
+    if current == scale:
+        print(f'reusing dataset: {args.venues} venues, {args.artists} artists, {args.shows} shows')
+        return
+    if any(current) and not args.regenerate:
+        raise SystemExit(f'{args.database_url} holds a different dataset '
+                         f'({current[0]} venues, {current[1]} artists, {current[2]} shows); '
+                         f'pass --regenerate to replace it')
+
+    print(f'generating dataset: {args.venues} venues, {args.artists} artists, {args.shows} shows')
+    db.drop_all()
+    db.create_all()
+    start = time.perf_counter()
+    generate(db, models, genres, *scale, seed=args.seed)
+    recount()
+    print(f'generated in {time.perf_counter() - start:.1f}s')
+
+#  Routes
+#  ----------------------------------------------------------------
+
+def routes(db, models, encode_cursor):
+    # (name, method, path, form data), with the busiest and a typical venue
+    # and artist so that both ends of the skew are measured
+    Venue, Artist, Show = models
+
+    def by_shows(column):
+        counts = db.session.query(column, db.func.count(Show.id)) \
+            .group_by(column) \
+            .order_by(db.func.count(Show.id).desc()) \
+            .all()
+        return counts[0][0], counts[len(counts) // 2][0]
+
+    busy_venue, typical_venue = by_shows(Show.venue_id)
+    busy_artist, typical_artist = by_shows(Show.artist_id)
+    past = encode_cursor([datetime.now(), 2 ** 31])
+    search_term = 'Blue'
+
+    return [
+        ('index', 'GET', '/', None),
+        ('venues', 'GET', '/venues', None),
+        ('artists', 'GET', '/artists', None),
+        ('shows', 'GET', '/shows', None),
+        ('show_venue busiest', 'GET', f'/venues/{busy_venue}', None),
+        ('show_venue typical', 'GET', f'/venues/{typical_venue}', None),
+        ('venue_past_shows busiest', 'GET', f'/venues/{busy_venue}/past_shows?before={past}', None),
+        ('show_artist busiest', 'GET', f'/artists/{busy_artist}', None),
+        ('show_artist typical', 'GET', f'/artists/{typical_artist}', None),
+        ('artist_past_shows busiest', 'GET', f'/artists/{busy_artist}/past_shows?before={past}', None),
+        ('search_venues', 'POST', '/venues/search', {'search_term': search_term}),
+        ('search_artists', 'POST', '/artists/search', {'search_term': search_term}),
+        ('edit_venue', 'GET', f'/venues/{typical_venue}/edit', None),
+        ('edit_artist', 'GET', f'/artists/{typical_artist}/edit', None),
+        ('create_venue_form', 'GET', '/venues/create', None),
+        ('create_artist_form', 'GET', '/artists/create', None),
+        ('create_shows', 'GET', '/shows/create', None),
+        ('api venues', 'GET', '/api/v1/venues', None),
+        ('api artists', 'GET', '/api/v1/artists', None),
+        ('api shows', 'GET', '/api/v1/shows', None),
+        ('api venue busiest', 'GET', f'/api/v1/venues/{busy_venue}', None),
+        ('api artist busiest', 'GET', f'/api/v1/artists/{busy_artist}', None),
+        ('api discover venues', 'GET', '/api/v1/venues/discover?genre=Jazz&state=CA&seeking=1', None),
+        ('api discover artists', 'GET', '/api/v1/artists/discover?genre=Jazz&genre=Blues', None),
+    ]
+
+def request_call(client, method, path, data):
+    def call():
+        if method == 'POST':
+            response = client.post(path, data=data)
+        else:
+            response = client.get(path)
+        if response.status_code != 200:
+            raise SystemExit(f'{method} {path} returned {response.status_code}')
+    return call
+
+def render_call(app, render_template, db, models, rows):
+    # the shows listing rendered with `rows` shows on one page, to measure
+    # template and date formatting cost apart from the page size limit
+    Venue, Artist, Show = models
+    shows = [{
+        'venue_id': show.venue_id,
+        'venue_name': show.venue_name,
+        'artist_id': show.artist_id,
+        'artist_name': show.artist_name,
+        'artist_image_link': show.artist_image_link,
+        'start_time': show.start_time,
+    } for show in db.session.query(Show.venue_id,
+                                   Venue.name.label('venue_name'),
+                                   Show.artist_id,
+                                   Artist.name.label('artist_name'),
+                                   Artist.image_link.label('artist_image_link'),
+                                   Show.start_time)
+        .join(Venue, Show.venue_id == Venue.id)
+        .join(Artist, Show.artist_id == Artist.id)
+        .order_by(Show.start_time, Show.id)
+        .limit(rows)]
+
+    def call():
+        with app.test_request_context('/shows'):
+            render_template('pages/shows.html', shows=shows, page=None)
+    return call
+
+def measure(call, engine, event, requests):
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        call()
+
+        latencies = []
+        statements.clear()
+        for _ in range(requests):
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+        statement_count = len(statements) / requests
+
+        tracemalloc.start()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    latencies.sort()
+    return {
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        'statements': statement_count,
+        'peak_kb': peak / 1024,
+    }
+
+#  Deletion
+#  ----------------------------------------------------------------
+
+def busy_venue(db, models, add_shows, shows, seed, batch_size=10000):
+    # a new venue with `shows` shows over two years around now, counted
+    Venue, Artist, Show = models
+    rng = random.Random(seed)
+    now = datetime.now()
+    venue = Venue(name=f'Deleted Hall {rng.randrange(10 ** 6)}', genres=['Jazz'],
+                  city='New York', state='NY', address='1 Main St')
+    db.session.add(venue)
+    db.session.commit()
+    artist_ids = [id for id, in db.session.query(Artist.id)]
+    for start in range(0, shows, batch_size):
+        rows = [(now + timedelta(minutes=rng.randrange(-365 * 24 * 60, 365 * 24 * 60)),
+                 venue.id, rng.choice(artist_ids))
+                for _ in range(min(batch_size, shows - start))]
+        db.session.bulk_insert_mappings(Show, [
+            {'start_time': start_time, 'venue_id': venue_id, 'artist_id': artist_id, 'updated_at': now}
+            for start_time, venue_id, artist_id in rows])
+        add_shows(rows)
+        db.session.commit()
+    return venue.id
+
+def delete_calls(db, models, deletion):
+    # each way of deleting a venue, given its id, as (name, [(label, call)]),
+    # every call timed on its own
+    Venue, Artist, Show = models
+
+    def orm_delete(venue_id):
+        # what the "all, delete" cascade did without passive_deletes
+        for show in Show.query.filter(Show.venue_id == venue_id).all():
+            db.session.delete(show)
+        db.session.delete(db.session.get(Venue, venue_id))
+        db.session.commit()
+
+    def soft_delete(venue_id):
+        # deletion.delete without queueing the purge, which is timed apart
+        db.session.get(Venue, venue_id).deleted_at = datetime.now()
+        db.session.commit()
+
+    def purge(venue_id):
+        deletion.purge('venue', venue_id)
+
+    return [('orm, show by show', [('orm, show by show', orm_delete)]),
+            ('soft delete + purge', [('  soft delete (request)', soft_delete),
+                                     ('  purge (job)', purge)])]
+
+def measure_delete(db, models, add_shows, deletion, event, args):
+    Venue, Artist, Show = models
+    print(f"\n{'delete a venue':28} {'seconds':>9} {'stmts':>6}   "
+          f'({args.delete_shows} shows)')
+    for name, steps in delete_calls(db, models, deletion):
+        venue_id = busy_venue(db, models, add_shows, args.delete_shows, args.seed)
+        db.session.close()
+        if len(steps) > 1:
+            print(name)
+        for label, step in steps:
+            statements = []
+
+            def count(*args):
+                statements.append(1)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                start = time.perf_counter()
+                step(venue_id)
+                elapsed = time.perf_counter() - start
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            db.session.close()
+            print(f'{label:28} {elapsed:9.3f} {len(statements):6}')
+        if db.session.query(Show.id).filter(Show.venue_id == venue_id).first() is not None:
+            raise SystemExit(f'{name} left shows of venue {venue_id}')
+
+#  Baselines
+#  ----------------------------------------------------------------
+
+def baseline_path(dialect, args):
+    return os.path.join(BASELINE_DIR, f'{dialect}-{args.venues}v-{args.artists}a-{args.shows}s.json')
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * tolerance:
+            failures.append(f"{name}: p95 {result['p95_ms']:.1f} ms, baseline {before['p95_ms']:.1f} ms")
+        if result['statements'] > before['statements']:
+            failures.append(f"{name}: {result['statements']:g} statements, baseline {before['statements']:g}")
+    return failures
+
+#  Scaling
+#  ----------------------------------------------------------------
+
+def scaled_database_url(args):
+    if args.scale_database_url:
+        return args.scale_database_url
+    if not args.database_url.startswith('sqlite:///'):
+        raise SystemExit('--scale-check needs --scale-database-url for this database')
+    base, extension = os.path.splitext(args.database_url)
+    return f'{base}-x{args.scale_check}{extension}'
+
+def scale_check(results, args):
+    # the routes whose statement count differs on a dataset args.scale_check
+    # times larger, measured by another run of this script
+    factor = args.scale_check
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'results.json')
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--database-url', scaled_database_url(args),
+                   '--venues', str(args.venues * factor),
+                   '--artists', str(args.artists * factor),
+                   '--shows', str(args.shows * factor),
+                   '--seed', str(args.seed), '--regenerate',
+                   '--requests', '3', '--render-rows', str(args.render_rows),
+                   '--results-json', output]
+        for name in args.only or ():
+            command += ['--route', name]
+        print(f'\nrunning at {factor}x scale:', flush=True)
+        subprocess.run(command, check=True)
+        with open(output) as file:
+            larger = json.load(file)
+
+    return [f"{name}: {result['statements']:g} statements, {larger[name]['statements']:g} at {factor}x"
+            for name, result in results.items()
+            if name in larger and larger[name]['statements'] != result['statements']]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Fyyur routes on a synthetic dataset.')
+    parser.add_argument('--database-url', default='sqlite:///' + os.path.abspath('bench.db'))
+    parser.add_argument('--venues', type=int, default=1000)
+    parser.add_argument('--artists', type=int, default=2000)
+    parser.add_argument('--shows', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--regenerate', action='store_true',
+                        help='drop and regenerate a database holding a different dataset')
+    parser.add_argument('--requests', type=int, default=30, help='timed requests per route')
+    parser.add_argument('--route', action='append', dest='only', help='only run routes with this name')
+    parser.add_argument('--render-rows', type=int, default=10000,
+                        help='shows in the large listing render (default: 10000)')
+    parser.add_argument('--delete-shows', type=int, default=0,
+                        help='also time deleting a venue with this many shows, e.g. 100000')
+    parser.add_argument('--scale-check', type=int, default=0, metavar='FACTOR',
+                        help='fail when statement counts change on a dataset FACTOR times larger')
+    parser.add_argument('--scale-database-url',
+                        help='database for --scale-check (default: a second SQLite file)')
+    parser.add_argument('--results-json', help='also write the results to this file, and stop '
+                                               'there (used by --scale-check)')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed p95 growth over the baseline (default: 1.5x)')
+    args = parser.parse_args()
+
+    # measure the application itself: no page cache, no slow request logs
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['CACHE_BACKEND'] = 'none'
+    os.environ.setdefault('PROFILE_SLOW_REQUEST_MS', '1e9')
+    os.environ.setdefault('PROFILE_SLOW_QUERY_MS', '1e9')
+
+    from sqlalchemy import event
+    from flask import render_template
+    from app import app, db, encode_cursor
+    from models import Venue, Artist, Show
+    from forms import VenueForm
+    import counters
+    import deletion
+
+    models = (Venue, Artist, Show)
+    genres = [value for value, _ in VenueForm.genres.kwargs['choices']]
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        prepare(db, models, genres, counters.recount, args)
+        dialect = db.engine.dialect.name
+        client = app.test_client()
+        calls = [(name, request_call(client, method, path, data))
+                 for name, method, path, data in routes(db, models, encode_cursor)]
+        calls.append((f'render shows {args.render_rows}',
+                      render_call(app, render_template, db, models, args.render_rows)))
+        selected = [(name, call) for name, call in calls if not args.only or name in args.only]
+
+        results = {}
+        print(f"{'route':28} {'p50 ms':>9} {'p95 ms':>9} {'stmts':>6} {'peak KB':>9}")
+        for name, call in selected:
+            result = measure(call, db.engine, event, args.requests)
+            results[name] = result
+            print(f"{name:28} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} "
+                  f"{result['statements']:6g} {result['peak_kb']:9.0f}")
+
+        if args.delete_shows:
+            measure_delete(db, models, counters.add_shows, deletion, event, args)
+
+    if args.results_json:
+        with open(args.results_json, 'w') as file:
+            json.dump(results, file)
+        return
+
+    if args.scale_check:
+        failures = scale_check(results, args)
+        if failures:
+            print('statement counts grow with the data:')
+            for failure in failures:
+                print('  ' + failure)
+            sys.exit(1)
+        print(f'statement counts unchanged at {args.scale_check}x scale')
+
+    path = baseline_path(dialect, args)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f'baseline saved to {path}')
+        return
+
+    if not os.path.exists(path):
+        print('no baseline for this database and scale; run with --save-baseline')
+        return
+    with open(path) as file:
+        failures = compare(results, json.load(file), args.tolerance)
+    if failures:
+        print('regressions against ' + path + ':')
+        for failure in failures:
+            print('  ' + failure)
+        sys.exit(1)
+    print('no regressions against ' + path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from app import app, db
+from models import Venue, Artist, Show
+import counters
+
+#----------------------------------------------------------------------------#
+# Show bookings.
+#----------------------------------------------------------------------------#
+
+# Shows are booked in batches (a tour is dozens of dates), all or none: the
+# whole batch is checked in one pass before anything is inserted. Every
+# venue and artist must exist, and no two shows may overlap at a venue, a
+# show holding its venue for SHOW_SLOT_MINUTES from its start.
+#
+# Existing shows close to the new ones are found with a single query, one
+# start_time range per new show on ix_shows_venue_id_start_time. The venues
+# are locked (SELECT ... FOR UPDATE) for the rest of the transaction, so
+# two bookings of the same venue are checked one after the other and cannot
+# both take the same slot. A valid batch is inserted with one multi-row
+# INSERT and counted with counters.add_shows.
+#
+# A booking is (line, artist_id, venue_id, start_time); line is the position
+# in the submitted batch, None for a single show, and only used in error
+# messages.
+
+def parse(text):
+    # bookings from text lines of "artist_id, venue_id, start time", and the
+    # errors of the lines that could not be read
+    bookings = []
+    errors = []
+    for line, row in enumerate(text.splitlines(), 1):
+        if not row.strip():
+            continue
+        fields = [field.strip() for field in row.split(',')]
+        if len(fields) != 3:
+            errors.append(f'line {line}: expected artist id, venue id and start time')
+            continue
+        try:
+            start_time = datetime.fromisoformat(fields[2])
+            if start_time.tzinfo is not None:
+                # stored times are naive, in server local time
+                raise ValueError(fields[2])
+            bookings.append((line, int(fields[0]), int(fields[1]), start_time))
+        except ValueError:
+            errors.append(f'line {line}: {row.strip()!r} is not an artist id, a venue id and '
+                          f'a YYYY-MM-DD HH:MM start time')
+    return bookings, errors
+
+def at(line):
+    return f'line {line}: ' if line else ''
+
+def overlapping(a, b):
+    return abs(a - b) < timedelta(minutes=app.config['SHOW_SLOT_MINUTES'])
+
+def check(bookings):
+    # errors found in the bookings, empty if they can all be inserted
+    errors = []
+    if len(bookings) > app.config['SHOW_BATCH_LIMIT']:
+        return [f'at most {app.config["SHOW_BATCH_LIMIT"]} shows can be listed at once']
+
+    venue_ids = {venue_id for _, _, venue_id, _ in bookings}
+    artist_ids = {artist_id for _, artist_id, _, _ in bookings}
+    venues = {id for id, in db.session.query(Venue.id)
+                                     .filter(Venue.id.in_(venue_ids))
+                                     .with_for_update()}
+    artists = {id for id, in db.session.query(Artist.id).filter(Artist.id.in_(artist_ids))}
+
+    slot = timedelta(minutes=app.config['SHOW_SLOT_MINUTES'])
+    booked = defaultdict(list)
+    if venues:
+        ranges = [db.and_(Show.venue_id == venue_id,
+                          Show.start_time > start_time - slot,
+                          Show.start_time < start_time + slot)
+                  for _, _, venue_id, start_time in bookings if venue_id in venues]
+        for venue_id, start_time in db.session.query(Show.venue_id, Show.start_time) \
+                .filter(db.or_(*ranges)):
+            booked[venue_id].append(start_time)
+
+    # shows of the batch are checked against the earlier ones at their venue
+    batch = defaultdict(list)
+    for line, artist_id, venue_id, start_time in bookings:
+        if venue_id not in venues:
+            errors.append(f'{at(line)}there is no venue {venue_id}')
+        if artist_id not in artists:
+            errors.append(f'{at(line)}there is no artist {artist_id}')
+        if any(overlapping(start_time, other) for other in booked[venue_id]):
+            errors.append(f'{at(line)}venue {venue_id} already has a show around '
+                          f'{start_time:%Y-%m-%d %H:%M}')
+        for other_line, other in batch[venue_id]:
+            if overlapping(start_time, other):
+                errors.append(f'{at(line)}overlaps line {other_line} at venue {venue_id}')
+        batch[venue_id].append((line, start_time))
+    return errors
+
+def book(bookings, errors=()):
+    # inserts the bookings in one transaction if they are all valid and
+    # there are no other errors (e.g. from parse); returns all the errors
+    # otherwise, having inserted nothing
+    try:
+        # the counter state is locked before the venues, in the order the
+        # counter rolls lock them
+        counters.state(db.session.connection())
+        errors = [*errors, *check(bookings)] if bookings else [*errors] or ['no shows given']
+        if errors:
+            db.session.rollback()
+            return errors
+
+        now = datetime.now()
+        db.session.execute(db.insert(Show), [{
+            'artist_id': artist_id,
+            'venue_id': venue_id,
+            'start_time': start_time,
+            'updated_at': now,
+        } for _, artist_id, venue_id, start_time in bookings])
+        counters.add_shows([(start_time, venue_id, artist_id)
+                            for _, artist_id, venue_id, start_time in bookings])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return []
@@ -0,0 +1,393 @@
+import fnmatch
+import time
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from functools import wraps
+from flask import g, request, session
+from app import app
+import jobs
+
+#----------------------------------------------------------------------------#
+# Page cache.
+#----------------------------------------------------------------------------#
+
+# Rendered GET pages are cached under their full path. While a view runs it
+# tags the page with the entities it displays (`tag('venue:1', 'artist:4')`),
+# and the submission handlers invalidate those tags after a successful
+# commit, so a write drops exactly the pages that showed what it changed.
+# Entries also expire after CACHE_TTL seconds, which covers shows moving
+# from upcoming to past as time goes by.
+#
+# A page rendered from rows read before a write may only be stored after
+# the write's invalidation ran. Each invalidation therefore bumps a
+# generation number and records it on the tags it drops; a page is not
+# stored when one of its tags was invalidated after its rendering started.
+#
+# Tags used:
+#   venues, artists, shows   the listing pages
+#   venue:<id>, artist:<id>  any page displaying that venue or artist
+
+
+class MemoryCache:
+    # in-process LRU with a per-entry TTL
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+        self.invalidated = 0.0
+        self.generation = 0
+        # tag: (generation, time) of its last invalidation, oldest first;
+        # kept for CACHE_TTL, longer than any rendering
+        self.tag_generations = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def current_generation(self):
+        with self.lock:
+            return self.generation
+
+    def set(self, key, value, tags, since=0):
+        # stores the page unless one of its tags was invalidated after
+        # generation `since`
+        with self.lock:
+            if any(self.tag_generations.get(tag, (0,))[0] > since for tag in tags):
+                return False
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+        return True
+
+    def invalidate(self, *tags):
+        with self.lock:
+            now = time.time()
+            self.invalidated = now
+            self.generation += 1
+            for tag in tags:
+                self.tag_generations.pop(tag, None)
+                self.tag_generations[tag] = (self.generation, now)
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+            while self.tag_generations and \
+                    next(iter(self.tag_generations.values()))[1] < now - self.ttl:
+                self.tag_generations.popitem(last=False)
+
+    def invalidated_at(self):
+        return self.invalidated
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+class RedisCache:
+    # shared cache for several workers, on any client with the redis-py
+    # get/mget/setex/incr/delete/sadd/smembers/expire/scan_iter API. Each tag is a set
+    # holding the keys of the pages carrying it.
+
+    def __init__(self, client, ttl, prefix='fyyur:page:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def current_generation(self):
+        return int(self.client.get(self.prefix + 'generation') or 0)
+
+    def set(self, key, value, tags, since=0):
+        # stored first and checked after: an invalidation running meanwhile
+        # either finds the page in its tag sets or has recorded its
+        # generation by the time of the check
+        key = self.prefix + key
+        self.client.setex(key, self.ttl, value)
+        for tag in tags:
+            self.client.sadd(self.prefix + 'tag:' + tag, key)
+            self.client.expire(self.prefix + 'tag:' + tag, self.ttl)
+        tags = list(tags)
+        if tags and any(int(generation or 0) > since for generation in self.client.mget(
+                [self.prefix + 'generation:' + tag for tag in tags])):
+            self.client.delete(key)
+            return False
+        return True
+
+    def invalidate(self, *tags):
+        self.client.setex(self.prefix + 'invalidated', self.ttl, time.time())
+        generation = self.client.incr(self.prefix + 'generation')
+        for tag in tags:
+            self.client.setex(self.prefix + 'generation:' + tag, self.ttl, generation)
+            tag = self.prefix + 'tag:' + tag
+            keys = self.client.smembers(tag)
+            self.client.delete(tag, *keys)
+
+    def invalidated_at(self):
+        # when any worker last invalidated pages
+        value = self.client.get(self.prefix + 'invalidated')
+        return float(value) if value is not None else 0.0
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class LocalRedis:
+    # single-process stand-in for a Redis server, implementing just the
+    # commands RedisCache and jobs.RedisQueue use, for development and tests
+    # without Redis
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def _live(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires < time.monotonic():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+        return self.values.get(key)
+
+    def get(self, key):
+        with self.lock:
+            value = self._live(key)
+            return None if isinstance(value, set) else value
+
+    def mget(self, keys):
+        with self.lock:
+            return [self._live(key) for key in keys]
+
+    def incr(self, key):
+        with self.lock:
+            value = int(self._live(key) or 0) + 1
+            self.values[key] = value
+            return value
+
+    def setex(self, key, ttl, value):
+        with self.lock:
+            self.values[key] = value
+            self.expires[key] = time.monotonic() + ttl
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.lock:
+            if nx and self._live(key) is not None:
+                return None
+            self.values[key] = value
+            self.expires.pop(key, None)
+            if ex is not None:
+                self.expires[key] = time.monotonic() + ex
+            return True
+
+    def sadd(self, key, *members):
+        with self.lock:
+            value = self._live(key)
+            if value is None:
+                value = self.values[key] = set()
+            value.update(members)
+
+    def smembers(self, key):
+        with self.lock:
+            return set(self._live(key) or ())
+
+    def expire(self, key, ttl):
+        with self.lock:
+            if self._live(key) is not None:
+                self.expires[key] = time.monotonic() + ttl
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+                self.expires.pop(key, None)
+
+    def lpush(self, key, *values):
+        with self.changed:
+            items = self._live(key)
+            if items is None:
+                items = self.values[key] = deque()
+            items.extendleft(values)
+            self.changed.notify_all()
+            return len(items)
+
+    def brpop(self, key, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while not self._live(key):
+                remaining = deadline - time.monotonic()
+                if timeout and remaining <= 0:
+                    return None
+                self.changed.wait(remaining if timeout else None)
+            return key, self.values[key].pop()
+
+    def llen(self, key):
+        with self.lock:
+            return len(self._live(key) or ())
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            return list(self._live(key) or ())[start:end + 1 if end != -1 else None]
+
+    def ltrim(self, key, start, end):
+        with self.lock:
+            items = self._live(key)
+            if items is not None:
+                self.values[key] = deque(list(items)[start:end + 1 if end != -1 else None])
+
+    def zadd(self, key, mapping):
+        with self.lock:
+            scores = self._live(key)
+            if scores is None:
+                scores = self.values[key] = {}
+            scores.update(mapping)
+
+    def zrangebyscore(self, key, low, high):
+        with self.lock:
+            scores = self._live(key) or {}
+            return sorted((member for member, score in scores.items() if low <= score <= high),
+                          key=scores.get)
+
+    def zrem(self, key, *members):
+        with self.lock:
+            scores = self._live(key) or {}
+            return sum(scores.pop(member, None) is not None for member in members)
+
+    def zcard(self, key):
+        with self.lock:
+            return len(self._live(key) or ())
+
+    def hincrby(self, key, field, amount=1):
+        with self.lock:
+            fields = self._live(key)
+            if fields is None:
+                fields = self.values[key] = {}
+            fields[field] = fields.get(field, 0) + amount
+            return fields[field]
+
+    hincrbyfloat = hincrby
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self._live(key) or {})
+
+    def scan_iter(self, match):
+        with self.lock:
+            keys = [key for key in self.values if fnmatch.fnmatchcase(key, match)]
+        return iter(keys)
+
+
+def create_backend(config):
+    backend = config['CACHE_BACKEND']
+    if backend == 'memory':
+        return MemoryCache(config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+    if backend == 'redis':
+        import redis
+        return RedisCache(redis.Redis.from_url(config['CACHE_REDIS_URL']), config['CACHE_TTL'])
+    if backend == 'local-redis':
+        return RedisCache(LocalRedis(), config['CACHE_TTL'])
+    if backend == 'none':
+        return None
+    raise ValueError(f'Unknown CACHE_BACKEND {backend!r}')
+
+backend = create_backend(app.config)
+
+# functions of the request that, besides its path, select the page it gets
+# (e.g. its locale); their values are part of every cache key
+variants = []
+
+def vary(function):
+    variants.append(function)
+    return function
+
+def variant_key():
+    return '|'.join(str(function()) for function in variants)
+
+def tag(*tags):
+    # mark the page being rendered as displaying these entities
+    g.setdefault('cache_tags', set()).update(tags)
+
+@jobs.job('invalidate-pages')
+def invalidate(*tags):
+    if backend is not None:
+        backend.invalidate(*tags)
+
+def invalidate_later(*tags):
+    # for submissions, which leave it to a job; the memory cache belongs to
+    # the process, so its job runs here. The submitter's next page carries a
+    # flashed message and is not served from the cache anyway.
+    if backend is not None:
+        jobs.enqueue('invalidate-pages', *tags, local=isinstance(backend, MemoryCache))
+
+def clear():
+    if backend is not None:
+        backend.clear()
+
+def storable():
+    # a page read from a replica soon after a write may not show it yet, and
+    # must not replace the page the write dropped; see replicas.py
+    return g.get('replica') is None \
+        or time.time() - backend.invalidated_at() > app.config['REPLICA_MAX_LAG_SECONDS']
+
+def cached(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # pages carrying flashed messages are personal, never cache them
+        if backend is None or request.method != 'GET' or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        key = request.full_path + '|' + variant_key()
+        body = backend.get(key)
+        if body is not None:
+            return body
+
+        since = backend.current_generation()
+        body = view(*args, **kwargs)
+        if not storable():
+            return body
+        tags = g.get('cache_tags', set())
+        if isinstance(body, str):
+            backend.set(key, body, tags, since)
+        elif isinstance(body, Iterator):
+            # a streamed page, see stream_template
+            body = store_when_sent(body, key, tags, since)
+        return body
+    return wrapper
+
+def store_when_sent(chunks, key, tags, since):
+    # streamed pages are cached once their last chunk has gone out; a
+    # stream the client abandons is not
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+        yield chunk
+    backend.set(key, ''.join(sent), tags, since)
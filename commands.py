@@ -0,0 +1,419 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+from datetime import datetime
+import click
+from sqlalchemy.dialects import postgresql
+from app import app, db
+from models import Venue, Artist, Show, ImportProgress
+import assets
+import cache
+import counters
+import discovery
+import jobs
+import matching
+import search
+
+#----------------------------------------------------------------------------#
+# Index checks.
+#----------------------------------------------------------------------------#
+
+# The queries every page depends on, each with the index it must be served
+# from. `flask check-indexes` runs EXPLAIN on each of them and fails when the
+# plan does not use that index, so a dropped index or a rewritten query that
+# can no longer use it is caught before it reaches production.
+
+def critical_queries():
+    now = datetime.now()
+    genres = db.cast(['Jazz'], postgresql.ARRAY(db.String))
+    return [
+        ('upcoming shows of a venue',
+         db.session.query(Show.id).filter(Show.venue_id == 1, Show.start_time > now),
+         'ix_shows_venue_id_start_time'),
+        ('upcoming shows of an artist',
+         db.session.query(Show.id).filter(Show.artist_id == 1, Show.start_time > now),
+         'ix_shows_artist_id_start_time'),
+        ('shows listing page',
+         db.session.query(Show.id).order_by(Show.start_time, Show.id).limit(30),
+         'ix_shows_start_time_id'),
+        # compiled here without the ORM events, so with the condition that
+        # hides deleted rows spelled out, see deletion.py
+        ('artists listing page',
+         db.session.query(Artist.id).filter(Artist.deleted_at.is_(None))
+         .order_by(Artist.name, Artist.id).limit(30),
+         'ix_artists_name_id'),
+        ('venues in an area',
+         db.session.query(Venue.id).filter(Venue.city == 'San Francisco', Venue.state == 'CA',
+                                           Venue.deleted_at.is_(None)),
+         'ix_venues_city_state'),
+        ('venue name search',
+         db.session.query(Venue.id).filter(Venue.name.ilike('%music%')),
+         'ix_venues_name_trgm'),
+        ('artist name search',
+         db.session.query(Artist.id).filter(Artist.name.ilike('%band%')),
+         'ix_artists_name_trgm'),
+        ('venues by genre',
+         db.session.query(Venue.id).filter(Venue.genres.op('@>')(genres)),
+         'ix_venues_genres'),
+        ('artists by genre',
+         db.session.query(Artist.id).filter(Artist.genres.op('@>')(genres)),
+         'ix_artists_genres'),
+    ]
+
+def plan_indexes(plan):
+    # names of all indexes referenced anywhere in an EXPLAIN (FORMAT JSON) plan
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names |= plan_indexes(child)
+    return names
+
+@app.cli.command('check-indexes')
+@click.option('--planner-default', is_flag=True,
+              help='Keep sequential scans enabled. Only meaningful on a '
+                   'database with production-sized tables.')
+def check_indexes(planner_default):
+    """Check that the critical queries are planned as index scans."""
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('check-indexes needs a PostgreSQL database.')
+
+    failures = 0
+    with db.engine.connect() as connection:
+        with connection.begin():
+            if not planner_default:
+                # small development tables are cheaper to scan than to index,
+                # so by default only check that the index can serve the query
+                connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+
+            for description, query, index in critical_queries():
+                compiled = query.statement.compile(dialect=connection.dialect)
+                [[explain]] = connection.exec_driver_sql(
+                    f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).all()
+                used = plan_indexes(explain[0]['Plan'])
+
+                if index in used:
+                    click.echo(f'ok    {description} ({index})')
+                else:
+                    failures += 1
+                    click.echo(f'FAIL  {description}: expected {index}, '
+                               f'plan uses {", ".join(sorted(used)) or "no index"}')
+
+    if failures:
+        raise click.ClickException(f'{failures} queries do not use their index.')
+
+#----------------------------------------------------------------------------#
+# Static assets.
+#----------------------------------------------------------------------------#
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Bundle, minify and fingerprint the stylesheets and scripts."""
+    for bundle, name in assets.build().items():
+        click.echo(f'{bundle:10} static/dist/{name}')
+
+    (requests_before, bytes_before), (requests_after, bytes_after) = assets.transfer_report()
+    click.echo(f'per page, cold cache: {requests_before} requests / {bytes_before / 1024:.1f} KB '
+               f'before, {requests_after} requests / {bytes_after / 1024:.1f} KB bundled and compressed')
+    click.echo('per page, warm cache: every source revalidated before, no requests bundled')
+
+#----------------------------------------------------------------------------#
+# Show counters.
+#----------------------------------------------------------------------------#
+
+@app.cli.command('roll-show-counters')
+@click.option('--recount', is_flag=True,
+              help='Count every show again instead of rolling the counters forward.')
+def roll_show_counters(recount):
+    """Move shows that have started from upcoming to past in the venue and
+    artist counters. Meant to run every few minutes, e.g. from cron."""
+    if recount:
+        counters.recount()
+        click.echo('recounted all venue and artist shows')
+    else:
+        moved = counters.roll()
+        if moved is None:
+            click.echo('no previous roll, recounted all venue and artist shows')
+        else:
+            click.echo(f'{moved} shows moved from upcoming to past')
+    # listings cached by other processes are only dropped with a shared cache
+    cache.invalidate('venues')
+
+#----------------------------------------------------------------------------#
+# Matches.
+#----------------------------------------------------------------------------#
+
+@app.cli.command('refresh-matches')
+@click.option('--full', is_flag=True,
+              help='Score every pair again, also picking up deleted shows, venues and artists.')
+def refresh_matches(full):
+    """Refresh the venues suggested to artists and the artists suggested
+    to venues. Meant to run every few minutes, e.g. from cron."""
+    if matching.np is None:
+        raise click.ClickException('refreshing matches needs NumPy')
+    start = time.perf_counter()
+    artist_ids, venue_ids = matching.refresh(full)
+    click.echo(f'refreshed the matches of {len(artist_ids)} artists and {len(venue_ids)} venues '
+               f'in {time.perf_counter() - start:.1f}s')
+    cache.invalidate(*[f'artist:{id}' for id in artist_ids], *[f'venue:{id}' for id in venue_ids])
+
+#----------------------------------------------------------------------------#
+# Jobs.
+#----------------------------------------------------------------------------#
+
+@app.cli.command('run-jobs')
+@click.option('--workers', type=int, help='Worker threads, JOB_WORKERS by default.')
+def run_jobs(workers):
+    """Run the jobs of the shared queue (JOB_BACKEND=redis) until
+    interrupted."""
+    if app.config['JOB_BACKEND'] != 'redis':
+        raise click.ClickException('run-jobs is for JOB_BACKEND=redis; other backends run '
+                                   'jobs in the process queuing them.')
+    queue, _ = jobs.queues()
+    threads = [threading.Thread(target=queue.work, daemon=True)
+               for _ in range(workers or app.config['JOB_WORKERS'])]
+    for thread in threads:
+        thread.start()
+    click.echo(f'running jobs with {len(threads)} workers')
+    try:
+        while True:
+            time.sleep(60)
+            status = queue.status()
+            click.echo(f"{status['depth']} due, {status['delayed']} delayed, "
+                       f"{status.get('done', 0):.0f} done, {status.get('given_up', 0):.0f} given up")
+    except KeyboardInterrupt:
+        pass
+
+#----------------------------------------------------------------------------#
+# Bulk import and export.
+#----------------------------------------------------------------------------#
+
+# `flask import-data shows shows.csv` / `flask export-data venues venues.jsonl`
+# stream CSV or JSON Lines files (chosen by extension) in batches, so memory
+# use depends on the batch size and not on the file size.
+#
+# Rows are inserted a batch per transaction, with COPY on PostgreSQL and
+# bulk INSERTs elsewhere. Each batch's transaction also saves the number of
+# rows done, in import_progress, and --resume skips them, so an interrupted
+# import can be restarted where it stopped without a batch going in twice.
+#
+# Rows may carry their ids (as exports do); shows may name their venue and
+# artist with venue_name / artist_name instead of venue_id / artist_id. In
+# CSV files genres are separated by semicolons.
+
+MODELS = {'venues': Venue, 'artists': Artist, 'shows': Show}
+
+# set on import, not carried between databases
+DERIVED_COLUMNS = ('updated_at', 'num_upcoming_shows', 'num_past_shows')
+
+def data_columns(model):
+    return [column for column in model.__table__.columns if column.key not in DERIVED_COLUMNS]
+
+def file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ('.csv', '.jsonl'):
+        raise click.ClickException('Files must be .csv or .jsonl.')
+    return extension[1:]
+
+def parse_value(column, value):
+    if value is None or value == '':
+        return None
+    type_ = column.type
+    if column.key == 'genres':
+        return value if isinstance(value, list) else value.split(';')
+    if isinstance(type_, db.Boolean):
+        return value if isinstance(value, bool) else value.strip().lower() in ('1', 'true', 't', 'y', 'yes')
+    if isinstance(type_, db.Integer):
+        return int(value)
+    if isinstance(type_, db.DateTime):
+        return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    return value
+
+def format_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ';'.join(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+def read_rows(path, fmt):
+    with open(path, newline='', encoding='utf-8') as file:
+        if fmt == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def resolve_names(batch, model, key, first_line):
+    # replace <key>_name with <key>_id, in one query per batch
+    names = {row[f'{key}_name'] for row in batch
+             if not row.get(f'{key}_id') and row.get(f'{key}_name')}
+    ids = {}
+    if names:
+        for id, name in db.session.query(model.id, model.name).filter(model.name.in_(names)):
+            if name in ids:
+                raise click.ClickException(f'{key} name {name!r} is ambiguous, use {key}_id.')
+            ids[name] = id
+
+    for line, row in enumerate(batch, first_line):
+        if not row.get(f'{key}_id'):
+            name = row.get(f'{key}_name')
+            if name not in ids:
+                raise click.ClickException(f'line {line}: unknown {key} {name!r}.')
+            row[f'{key}_id'] = ids[name]
+
+def copy_rows(model, columns, rows):
+    # COPY ... FROM STDIN in CSV format, with arrays as PostgreSQL literals
+    def copy_value(value):
+        if isinstance(value, list):
+            return '{' + ','.join('"' + item.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                                  for item in value) + '}'
+        return format_csv_value(value)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([copy_value(row[column.key]) for column in columns])
+    buffer.seek(0)
+
+    names = ', '.join(column.name for column in columns)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f'COPY {model.__tablename__} ({names}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+@app.cli.command('import-data')
+@click.argument('table', type=click.Choice(sorted(MODELS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--resume', is_flag=True, help='Skip the rows a previous run committed.')
+def import_data(table, path, batch_size, resume):
+    """Import venues, artists or shows from a CSV or JSONL file."""
+    model = MODELS[table]
+    fmt = file_format(path)
+    progress_key = os.path.abspath(path)
+    use_copy = db.engine.dialect.name == 'postgresql'
+
+    done = 0
+    progress = db.session.get(ImportProgress, progress_key)
+    if resume and progress is not None:
+        done = progress.rows
+        click.echo(f'resuming after {done} rows')
+
+    rows = read_rows(path, fmt)
+    for _ in range(done):
+        next(rows, None)
+
+    start = time.perf_counter()
+    imported = 0
+    with_ids = False
+    for batch in batches(rows, batch_size):
+        if model is Show:
+            # file line of the batch's first row, past the CSV header
+            first_line = done + (2 if fmt == 'csv' else 1)
+            resolve_names(batch, Venue, 'venue', first_line)
+            resolve_names(batch, Artist, 'artist', first_line)
+
+        now = datetime.now()
+        columns = [column for column in data_columns(model) if column.key != 'id' or 'id' in batch[0]]
+        with_ids = with_ids or any(column.key == 'id' for column in columns)
+        values = [{**{column.key: parse_value(column, row.get(column.key)) for column in columns},
+                   'updated_at': now}
+                  for row in batch]
+        for column in columns:
+            # fill in the model defaults (e.g. seeking flags) a file leaves out
+            if column.default is not None and column.default.is_scalar:
+                for value in values:
+                    if value[column.key] is None:
+                        value[column.key] = column.default.arg
+
+        try:
+            if use_copy:
+                copy_rows(model, columns + [model.__table__.c.updated_at], values)
+            else:
+                db.session.bulk_insert_mappings(model, values)
+            # committed with the rows, so that a resume never inserts them again
+            db.session.merge(ImportProgress(path=progress_key, rows=done + len(batch)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        done += len(batch)
+        imported += len(batch)
+
+        elapsed = time.perf_counter() - start
+        click.echo(f'{done} rows ({imported / elapsed:.0f} rows/s)')
+
+    if with_ids and use_copy:
+        # explicit ids leave the id sequence behind the table
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{model.__tablename__}', 'id'), "
+            f"(SELECT coalesce(max(id), 1) FROM {model.__tablename__}))"))
+        db.session.commit()
+
+    db.session.execute(db.delete(ImportProgress).where(ImportProgress.path == progress_key))
+    db.session.commit()
+
+    # bulk inserts bypass the ORM events that keep these current
+    if model is Show:
+        counters.recount()
+    cache.clear()
+    search.reset()
+    discovery.reset()
+    click.echo(f'imported {imported} {table} in {time.perf_counter() - start:.1f}s')
+
+@app.cli.command('export-data')
+@click.argument('table', type=click.Choice(sorted(MODELS)))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--batch-size', default=5000, show_default=True)
+def export_data(table, path, batch_size):
+    """Export venues, artists or shows to a CSV or JSONL file."""
+    model = MODELS[table]
+    fmt = file_format(path)
+    columns = data_columns(model)
+    keys = [column.key for column in columns]
+
+    query = db.session.query(*columns)
+    if model is Show:
+        # deleted venues and artists are not exported, nor are their shows
+        # (until purged, see deletion.py), so that the files import again
+        query = query.join(Venue, Show.venue_id == Venue.id) \
+            .join(Artist, Show.artist_id == Artist.id)
+    query = query.order_by(model.id) \
+        .execution_options(stream_results=True, yield_per=batch_size)
+
+    start = time.perf_counter()
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(keys)
+
+        for row in query:
+            if writer:
+                writer.writerow([format_csv_value(value) for value in row])
+            else:
+                file.write(json.dumps({key: value.isoformat() if isinstance(value, datetime) else value
+                                       for key, value in zip(keys, row)}) + '\n')
+            count += 1
+            if count % batch_size == 0:
+                click.echo(f'{count} rows ({count / (time.perf_counter() - start):.0f} rows/s)')
+
+    click.echo(f'exported {count} {table} in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,182 @@
+from collections import defaultdict
+from datetime import datetime
+import dateutil.parser
+from sqlalchemy import event, inspect
+from app import db
+from models import Venue, Artist, Show, ShowCounterState
+
+#----------------------------------------------------------------------------#
+# Show counters.
+#----------------------------------------------------------------------------#
+
+# Venues and artists carry num_upcoming_shows and num_past_shows, so the
+# listings and search results read a column instead of counting shows.
+#
+# A show counts as upcoming while it starts after the rolled_at time kept in
+# show_counter_state, not after the current time. Inserting, moving or
+# deleting a show through the ORM adjusts the counters of its venue and
+# artist in the same transaction, and `flask roll-show-counters`, run
+# periodically (e.g. every few minutes from cron), moves the shows that
+# started since its last run from upcoming to past and advances rolled_at.
+# Counters therefore lag the clock by at most the roll interval.
+#
+# Writes that bypass the ORM call add_shows() for the shows they insert
+# (batched bookings), remove_shows_of() for the shows deleted along with
+# their venue or artist (deletion.py) or recount(), which counts everything
+# again from the shows table (bulk imports).
+#
+# Rolls and recounts lock the state row exclusively and show writes lock it
+# shared, so a show is never classified against a rolled_at being moved.
+
+OWNERS = ((Venue, Show.venue_id), (Artist, Show.artist_id))
+
+def state(connection, exclusive=False):
+    query = db.select(ShowCounterState.rolled_at).where(ShowCounterState.id == 1) \
+        .with_for_update(read=not exclusive)
+    return connection.execute(query).scalar()
+
+def counter(rolled_at, start_time):
+    # before the first roll every show counts as upcoming
+    if rolled_at is None or start_time > rolled_at:
+        return 'num_upcoming_shows'
+    return 'num_past_shows'
+
+def adjust(connection, rolled_at, values, delta):
+    # values: (start_time, venue_id, artist_id) of one show
+    start_time, *owner_ids = values
+    if isinstance(start_time, str):
+        # form submissions assign the submitted text
+        start_time = dateutil.parser.parse(start_time)
+    key = counter(rolled_at, start_time)
+
+    for (model, _), owner_id in zip(OWNERS, owner_ids):
+        table = model.__table__
+        connection.execute(db.update(table)
+                           .where(table.c.id == owner_id)
+                           .values({key: table.c[key] + delta}))
+
+def show_values(show):
+    return (show.start_time, show.venue_id, show.artist_id)
+
+@event.listens_for(Show, 'after_insert')
+def on_insert(mapper, connection, target):
+    adjust(connection, state(connection), show_values(target), 1)
+
+# assignments load the old value, even of an expired attribute, so that
+# on_update knows which counters the show was in
+for key in ('start_time', 'venue_id', 'artist_id'):
+    event.listen(getattr(Show, key), 'set', lambda *args: None, active_history=True)
+
+@event.listens_for(Show, 'after_update')
+def on_update(mapper, connection, target):
+    attrs = inspect(target).attrs
+    keys = ('start_time', 'venue_id', 'artist_id')
+    if not any(attrs[key].history.has_changes() for key in keys):
+        return
+    old = tuple(attrs[key].history.deleted[0] if attrs[key].history.deleted
+                else getattr(target, key) for key in keys)
+    rolled_at = state(connection)
+    adjust(connection, rolled_at, old, -1)
+    adjust(connection, rolled_at, show_values(target), 1)
+
+@event.listens_for(Show, 'after_delete')
+def on_delete(mapper, connection, target):
+    adjust(connection, state(connection), show_values(target), -1)
+
+def update_counters(connection, model, deltas):
+    # deltas: {(counter column, venue or artist id): change}; each counter
+    # column is updated with one executemany over the rows it changes
+    table = model.__table__
+    for key in ('num_upcoming_shows', 'num_past_shows'):
+        params = [{'owner_id': owner_id, 'delta': delta}
+                  for (column, owner_id), delta in deltas.items() if column == key]
+        if params:
+            connection.execute(db.update(table)
+                               .where(table.c.id == db.bindparam('owner_id'))
+                               .values({key: table.c[key] + db.bindparam('delta')}),
+                               params)
+
+def add_shows(shows):
+    # counts shows inserted in bulk, bypassing the ORM events, given as
+    # (start_time, venue_id, artist_id)
+    connection = db.session.connection()
+    rolled_at = state(connection)
+    for index, (model, _) in enumerate(OWNERS, 1):
+        deltas = defaultdict(int)
+        for show in shows:
+            deltas[counter(rolled_at, show[0]), show[index]] += 1
+        update_counters(connection, model, deltas)
+
+def remove_shows_of(owner_column, owner_id):
+    # uncounts the shows of a venue or artist that the database is about to
+    # delete along with it (ON DELETE CASCADE, bypassing the ORM events) from
+    # the counters of the other side, counted per artist or venue by the
+    # database; returns the ids of those artists or venues
+    connection = db.session.connection()
+    rolled_at = state(connection)
+    [(model, other_column)] = [(model, column) for model, column in OWNERS
+                               if column is not owner_column]
+    upcoming = Show.start_time > rolled_at if rolled_at is not None else db.true()
+    rows = connection.execute(db.select(other_column,
+                                        db.func.count().filter(upcoming),
+                                        db.func.count().filter(db.not_(upcoming)))
+                              .where(owner_column == owner_id)
+                              .group_by(other_column)).all()
+    deltas = {}
+    for other_id, upcoming_count, past_count in rows:
+        deltas['num_upcoming_shows', other_id] = -upcoming_count
+        deltas['num_past_shows', other_id] = -past_count
+    update_counters(connection, model, deltas)
+    return [other_id for other_id, _, _ in rows]
+
+def set_rolled_at(connection, now):
+    if connection.execute(db.update(ShowCounterState.__table__)
+                          .where(ShowCounterState.id == 1)
+                          .values(rolled_at=now)).rowcount == 0:
+        connection.execute(db.insert(ShowCounterState.__table__).values(id=1, rolled_at=now))
+
+def recount(now=None):
+    now = now or datetime.now()
+    connection = db.session.connection()
+    state(connection, exclusive=True)
+
+    for model, owner_column in OWNERS:
+        def count(condition):
+            return db.select(db.func.count(Show.id)) \
+                .where(owner_column == model.id, condition) \
+                .scalar_subquery()
+        connection.execute(db.update(model.__table__).values(
+            num_upcoming_shows=count(Show.start_time > now),
+            num_past_shows=count(Show.start_time <= now)))
+
+    set_rolled_at(connection, now)
+    db.session.commit()
+
+def roll(now=None):
+    # returns the number of shows moved from upcoming to past
+    now = now or datetime.now()
+    connection = db.session.connection()
+    rolled_at = state(connection, exclusive=True)
+    if rolled_at is None:
+        db.session.rollback()
+        recount(now)
+        return None
+
+    started = db.and_(Show.start_time > rolled_at, Show.start_time <= now)
+    moved = connection.execute(db.select(db.func.count(Show.id)).where(started)).scalar()
+    if moved:
+        # only the venues and artists with newly started shows are touched,
+        # each found through its (owner, start_time) index
+        for model, owner_column in OWNERS:
+            started_here = db.select(db.func.count(Show.id)) \
+                .where(owner_column == model.id, started) \
+                .scalar_subquery()
+            table = model.__table__
+            connection.execute(db.update(table)
+                               .where(table.c.id.in_(db.select(owner_column).where(started)))
+                               .values(num_upcoming_shows=table.c.num_upcoming_shows - started_here,
+                                       num_past_shows=table.c.num_past_shows + started_here))
+
+    set_rolled_at(connection, now)
+    db.session.commit()
+    return moved
@@ -0,0 +1,82 @@
+from datetime import datetime
+from sqlalchemy import event, orm
+from app import db
+from models import Venue, Artist, Show, Match
+import cache
+import counters
+import jobs
+import matching
+
+#----------------------------------------------------------------------------#
+# Deleting venues and artists.
+#----------------------------------------------------------------------------#
+
+# A venue or artist is deleted in two steps. delete() only sets its
+# deleted_at, one UPDATE however many shows it has; from then on ORM
+# queries leave it out, as every SELECT of Venue or Artist, joined or not,
+# gets "deleted_at IS NULL" added (hide_deleted below). Queries that must
+# see deleted rows pass execution_options(include_deleted=True). The
+# listing indexes are partial on the same condition.
+#
+# delete() then queues purge() as a job (see jobs.py), which deletes the row
+# for good. The database deletes its shows and matches along with it (ON
+# DELETE CASCADE; the relationships are passive_deletes, so the ORM does not
+# load them first). No ORM event fires for those rows, so purge() itself
+# takes the shows off the counters of the other side (one grouped query, see
+# counters.py) and marks the artists or venues that listed the deleted one
+# among their matches as changed, for the next matching refresh. Until the
+# purge has run, the show counts of the other side still include the shows
+# of the deleted one.
+
+KINDS = {
+    # kind: (model, its column in shows, its column in matches, the other
+    #        kind, the other's column in matches)
+    'venue': (Venue, Show.venue_id, Match.venue_id, 'artist', Match.artist_id),
+    'artist': (Artist, Show.artist_id, Match.artist_id, 'venue', Match.venue_id),
+}
+
+@event.listens_for(orm.Session, 'do_orm_execute')
+def hide_deleted(state):
+    if not state.is_select or state.is_column_load or state.is_relationship_load \
+            or state.execution_options.get('include_deleted', False):
+        return
+    state.statement = state.statement.options(
+        orm.with_loader_criteria(Venue, lambda cls: cls.deleted_at.is_(None), include_aliases=True),
+        orm.with_loader_criteria(Artist, lambda cls: cls.deleted_at.is_(None), include_aliases=True))
+
+def delete(kind, id):
+    # hides the venue or artist and queues its purge; False if there is no
+    # such venue or artist
+    model = KINDS[kind][0]
+    entity = db.session.get(model, id)
+    if entity is None:
+        return False
+    entity.deleted_at = datetime.now()
+    db.session.commit()
+    jobs.enqueue('purge', kind, id, key=f'purge:{kind}:{id}')
+    return True
+
+@jobs.job('purge')
+def purge(kind, id):
+    model, owner_column, match_column, other_kind, other_match_column = KINDS[kind]
+    other = KINDS[other_kind][0]
+    entity = db.session.get(model, id, execution_options={'include_deleted': True})
+    if entity is None or entity.deleted_at is None:
+        # purged already, or not deleted
+        return
+
+    try:
+        other_ids = counters.remove_shows_of(owner_column, id)
+        listing = db.select(other_match_column).where(match_column == id)
+        db.session.execute(db.update(other)
+                           .where(other.id.in_(listing))
+                           .values(updated_at=datetime.now())
+                           .execution_options(synchronize_session=False))
+        db.session.delete(entity)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    cache.invalidate(f'{other_kind}s', *[f'{other_kind}:{other_id}' for other_id in other_ids])
+    matching.refresh_later()
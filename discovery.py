@@ -0,0 +1,283 @@
+import threading
+import time
+from array import array
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql
+from app import app, db
+from models import Venue, Artist, after_commit
+
+#----------------------------------------------------------------------------#
+# Genre discovery.
+#----------------------------------------------------------------------------#
+
+# Venues and artists are browsed by a set of genres (all of them must be
+# listed), city, state and whether they are seeking talent or venues, with
+# the number of results each further genre would leave.
+#
+# The results themselves are a query: on PostgreSQL the genres are matched
+# by array containment (genres @> ARRAY[...]) on the ix_*_genres GIN
+# indexes; elsewhere (SQLite) with json_each. The facet counts come from an
+# in-process inverted index instead of a GROUP BY over every match: each
+# genre and the seeking flag are bitmaps over ids (Python ints, bit n set
+# for id n), cities and states lists of ids. A filter is the AND of its
+# bitmaps, and the count for a genre the popcount of the filter AND the
+# genre's bitmap, a few milliseconds at a million rows.
+#
+# The index is built on first use and kept in step with the ORM writes this
+# process commits, deletions included (see deletion.py). It is rebuilt in the
+# background every DISCOVERY_INDEX_TTL seconds to pick up the writes of
+# other processes and bulk imports, so counts may lag those by that much;
+# this process's commits during the build are replayed onto the new index.
+# reset() drops it at once. On PostgreSQL the build is a handful of
+# array_agg queries, about 4s for a million rows.
+
+def to_bitmap(ids):
+    bits = bytearray(max(ids, default=0) // 8 + 1)
+    for id in ids:
+        bits[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(bits, 'little')
+
+def without(bitmap, id):
+    return bitmap & ~(1 << id)
+
+def add_to(data, id, genres, city, state, seeking):
+    bit = 1 << id
+    data['ids'] |= bit
+    for genre in genres or ():
+        data['genres'][genre] = data['genres'].get(genre, 0) | bit
+    if seeking:
+        data['seeking'] |= bit
+    for kind, value in (('cities', city), ('states', state)):
+        # a change replayed onto a rebuilt index may be in it already
+        ids = data[kind].setdefault(value, array('l'))
+        if id not in ids:
+            ids.append(id)
+        if (kind, value) in data['places']:
+            data['places'][kind, value] |= bit
+
+def discard_from(data, id, genres, city, state):
+    data['ids'] = without(data['ids'], id)
+    for genre in genres or ():
+        if genre in data['genres']:
+            data['genres'][genre] = without(data['genres'][genre], id)
+    data['seeking'] = without(data['seeking'], id)
+    for kind, value in (('cities', city), ('states', state)):
+        if id in data[kind].get(value, ()):
+            data[kind][value].remove(id)
+        if (kind, value) in data['places']:
+            data['places'][kind, value] = without(data['places'][kind, value], id)
+
+
+class FacetIndex:
+
+    def __init__(self, model, seeking_column):
+        self.model = model
+        self.seeking_column = seeking_column
+        self.data = None
+        self.built_at = None
+        self.lock = threading.Lock()
+        self.building = False
+        # changes committed during a rebuild, see change()
+        self.changes = None
+
+    def grouped(self, key):
+        # {value of key: ids of the rows with that value}
+        return dict(db.session.query(key, db.func.array_agg(self.model.id)).group_by(key))
+
+    def build(self):
+        if db.engine.dialect.name == 'postgresql':
+            # aggregated by the server, a few queries returning arrays of ids
+            # instead of a row per entity
+            all_ids, seeking_ids = db.session.query(
+                db.func.array_agg(self.model.id),
+                db.func.array_agg(self.model.id).filter(self.seeking_column.is_(True))).one()
+            genre_ids = self.grouped(db.func.unnest(self.model.genres))
+            cities = self.grouped(self.model.city)
+            states = self.grouped(self.model.state)
+        else:
+            all_ids = []
+            genre_ids = {}
+            seeking_ids = []
+            cities = {}
+            states = {}
+            query = db.session.query(self.model.id, self.model.genres, self.model.city,
+                                     self.model.state, self.seeking_column)
+            for id, entity_genres, city, state, entity_seeking in query:
+                all_ids.append(id)
+                for genre in entity_genres or ():
+                    genre_ids.setdefault(genre, []).append(id)
+                if entity_seeking:
+                    seeking_ids.append(id)
+                cities.setdefault(city, []).append(id)
+                states.setdefault(state, []).append(id)
+
+        return {
+            'ids': to_bitmap(all_ids or ()),
+            'genres': {genre: to_bitmap(ids) for genre, ids in genre_ids.items()},
+            'seeking': to_bitmap(seeking_ids or ()),
+            'cities': {city: array('l', ids) for city, ids in cities.items()},
+            'states': {state: array('l', ids) for state, ids in states.items()},
+            # bitmaps of the cities and states filtered on lately
+            'places': {},
+        }
+
+    def rebuild(self):
+        try:
+            with self.lock:
+                self.changes = []
+            with app.app_context():
+                data = self.build()
+            with self.lock:
+                # the build may have missed the changes committed while it ran
+                for apply, args in self.changes:
+                    apply(data, *args)
+                self.data = data
+                self.built_at = time.monotonic()
+        finally:
+            with self.lock:
+                self.changes = None
+            self.building = False
+
+    def current(self):
+        if self.data is None:
+            with self.lock:
+                if self.data is None:
+                    self.data = self.build()
+                    self.built_at = time.monotonic()
+        elif time.monotonic() - self.built_at > app.config['DISCOVERY_INDEX_TTL'] \
+                and not self.building:
+            # the stale index keeps serving until the new one is ready
+            self.building = True
+            threading.Thread(target=self.rebuild, daemon=True).start()
+        return self.data
+
+    def facets(self, genres=(), city=None, state=None, seeking=False):
+        # (number of matches, {genre: number of matches also in that genre})
+        data = self.current()
+        matching = data['ids']
+        for genre in genres:
+            matching &= data['genres'].get(genre, 0)
+        if seeking:
+            matching &= data['seeking']
+        if city:
+            matching &= self.place(data, 'cities', city)
+        if state:
+            matching &= self.place(data, 'states', state)
+        counts = {genre: (matching & bitmap).bit_count()
+                  for genre, bitmap in list(data['genres'].items())}
+        return matching.bit_count(), counts
+
+    def place(self, data, kind, value):
+        # under the lock, as change() updates the cached bitmaps
+        with self.lock:
+            bitmap = data['places'].get((kind, value))
+            if bitmap is None:
+                bitmap = to_bitmap(data[kind].get(value, ()))
+                if len(data['places']) >= 64:
+                    data['places'].clear()
+                data['places'][kind, value] = bitmap
+            return bitmap
+
+    #  Keeping in step
+    #  ----------------------------------------------------------------
+
+    def change(self, apply, *args):
+        # applied to the index in use and, while a rebuild runs, recorded to
+        # be applied to the new one as well
+        with self.lock:
+            if self.data is not None:
+                apply(self.data, *args)
+            if self.changes is not None:
+                self.changes.append((apply, args))
+
+    def add(self, id, genres, city, state, seeking):
+        self.change(add_to, id, genres, city, state, seeking)
+
+    def discard(self, id, genres, city, state):
+        self.change(discard_from, id, genres, city, state)
+
+    def keys(self):
+        return ('genres', 'city', 'state', self.seeking_column.key)
+
+    def values(self, target):
+        return [getattr(target, key) for key in self.keys()]
+
+    def listen(self):
+        # the values are read during the flush, and the index changed once
+        # the transaction commits
+        def on_insert(mapper, connection, target):
+            id, new = target.id, self.values(target)
+            after_commit(target, lambda: self.add(id, *new))
+
+        def on_update(mapper, connection, target):
+            attrs = inspect(target).attrs
+            id = target.id
+            if any(attrs.deleted_at.history.added):
+                # soft deleted, see deletion.py
+                old = self.values(target)
+                after_commit(target, lambda: self.discard(id, *old[:3]))
+                return
+            if not any(attrs[key].history.has_changes() for key in self.keys()):
+                return
+            old = [attrs[key].history.deleted[0] if attrs[key].history.deleted
+                   else getattr(target, key) for key in self.keys()]
+            new = self.values(target)
+
+            def change():
+                self.discard(id, *old[:3])
+                self.add(id, *new)
+            after_commit(target, change)
+
+        def on_delete(mapper, connection, target):
+            id, old = target.id, self.values(target)
+            after_commit(target, lambda: self.discard(id, *old[:3]))
+
+        # assignments load the old value, even of an expired attribute, so
+        # that on_update knows what to take out
+        for key in self.keys():
+            event.listen(getattr(self.model, key), 'set', lambda *args: None, active_history=True)
+
+        event.listen(self.model, 'after_insert', on_insert)
+        event.listen(self.model, 'after_update', on_update)
+        event.listen(self.model, 'after_delete', on_delete)
+        return self
+
+    def reset(self):
+        # rebuilt on the next use
+        with self.lock:
+            self.data = None
+
+
+indexes = {
+    Venue: FacetIndex(Venue, Venue.seeking_talent).listen(),
+    Artist: FacetIndex(Artist, Artist.seeking_venue).listen(),
+}
+
+def reset():
+    # for writes that bypass the ORM events, e.g. bulk imports
+    for index in indexes.values():
+        index.reset()
+
+def has_genres(model, genres):
+    if db.engine.dialect.name == 'postgresql':
+        return model.genres.op('@>')(db.cast(list(genres), postgresql.ARRAY(db.String)))
+    conditions = []
+    for genre in genres:
+        listed = db.func.json_each(model.genres).table_valued('value')
+        conditions.append(db.exists().select_from(listed).where(listed.c.value == genre))
+    return db.and_(*conditions)
+
+def filtered(model, query, genres=(), city=None, state=None, seeking=False):
+    # query narrowed to the venues or artists matching the filters
+    if genres:
+        query = query.filter(has_genres(model, genres))
+    if city:
+        query = query.filter(model.city == city)
+    if state:
+        query = query.filter(model.state == state)
+    if seeking:
+        query = query.filter(indexes[model].seeking_column.is_(True))
+    return query
+
+def facets(model, **filters):
+    return indexes[model].facets(**filters)
@@ -0,0 +1,117 @@
+import re
+from functools import lru_cache
+from zoneinfo import ZoneInfo, available_timezones
+import babel.dates
+import dateutil.parser
+from babel import Locale
+from flask import g, request, has_request_context
+from app import app
+import cache
+
+#----------------------------------------------------------------------------#
+# Date formatting.
+#----------------------------------------------------------------------------#
+
+# The `datetime` template filter formats show times in the locale and the
+# timezone of the request: the best match for Accept-Language among
+# LOCALES, and the IANA zone named by the `tz` cookie or DISPLAY_TIMEZONE.
+# Without a timezone, stored times (naive, server local) are shown as is.
+#
+# babel.dates.format_datetime parses its pattern and resolves the locale on
+# every call. Here each (locale, format) pair is compiled once into a
+# function filling the pattern from the locale's names, with Babel itself
+# only used for the fields the compiler does not know. Datetimes are
+# formatted as they are; only strings are parsed.
+
+FORMATS = {
+    'full': "EEEE MMMM, d, y 'at' h:mm a",
+    'medium': "EE MM, dd, y h:mm a",
+}
+
+NAME_WIDTHS = {1: 'abbreviated', 2: 'abbreviated', 3: 'abbreviated', 4: 'wide', 5: 'narrow', 6: 'short'}
+
+def padded(get, width):
+    return lambda value: str(get(value)).zfill(width)
+
+def compile_field(field, locale):
+    # a function of a datetime returning the text of one pattern field, the
+    # same as babel.dates.DateTimeFormat(value, locale)[field]
+    char, width = field[0], len(field)
+    if char == 'E':
+        names = locale.days['format'][NAME_WIDTHS[width]]
+        return lambda value: names[value.weekday()]
+    if char == 'M' and width >= 3:
+        names = locale.months['format'][NAME_WIDTHS[width]]
+        return lambda value: names[value.month]
+    if char == 'a' and width <= 3:
+        names = locale.day_periods['format']['abbreviated']
+        return lambda value: names['pm' if value.hour >= 12 else 'am']
+    if char == 'y' and width == 2:
+        return padded(lambda value: value.year % 100, 2)
+    getters = {
+        'y': lambda value: value.year,
+        'M': lambda value: value.month,
+        'd': lambda value: value.day,
+        'h': lambda value: value.hour % 12 or 12,
+        'H': lambda value: value.hour,
+        'm': lambda value: value.minute,
+        's': lambda value: value.second,
+    }
+    if char in getters:
+        return padded(getters[char], width)
+    return lambda value: babel.dates.DateTimeFormat(value, locale)[field]
+
+# bounded, in case a caller passes formats of its own
+@lru_cache(maxsize=256)
+def formatter(locale, format):
+    pattern = babel.dates.parse_pattern(FORMATS.get(format, format))
+    locale = Locale.parse(locale)
+    fields = [(field, compile_field(field, locale))
+              for field in dict.fromkeys(re.findall(r'%\((\w+)\)s', pattern.format))]
+
+    def format_value(value):
+        return pattern.format % {field: get(value) for field, get in fields}
+    return format_value
+
+@lru_cache(maxsize=None)
+def zone_names():
+    return available_timezones()
+
+@lru_cache(maxsize=None)
+def known_zone(name):
+    return ZoneInfo(name)
+
+def zone(name):
+    # None unless name is an IANA zone; the name comes from a cookie, so
+    # only known zones are cached
+    return known_zone(name) if name in zone_names() else None
+
+def request_locale():
+    locales = app.config['LOCALES']
+    if not has_request_context():
+        return locales[0]
+    if 'locale' not in g:
+        g.locale = request.accept_languages.best_match(locales, default=locales[0])
+    return g.locale
+
+def request_timezone():
+    if not has_request_context():
+        return zone(app.config['DISPLAY_TIMEZONE']) if app.config['DISPLAY_TIMEZONE'] else None
+    if 'timezone' not in g:
+        name = request.cookies.get('tz') or app.config['DISPLAY_TIMEZONE']
+        g.timezone = zone(name) if name else None
+    return g.timezone
+
+@cache.vary
+def variant():
+    # pages cached per locale and timezone
+    timezone = request_timezone()
+    return f'{request_locale()}:{timezone.key if timezone else ""}'
+
+def format_datetime(value, format='medium'):
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    timezone = request_timezone()
+    if timezone is not None:
+        value = value.astimezone(timezone)
+    return formatter(request_locale(), format)(value)
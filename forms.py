@@ -1,6 +1,6 @@
 from datetime import datetime
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired, AnyOf, URL
 
 class ShowForm(FlaskForm):
@@ -16,6 +16,12 @@ class ShowForm(FlaskForm):
         default= datetime.today()
     )
 
+class ShowBatchForm(FlaskForm):
+    # one show per line: artist id, venue id, start time
+    shows = TextAreaField(
+        'shows', validators=[DataRequired()]
+    )
+
 class VenueForm(FlaskForm):
     name = StringField(
         'name', validators=[DataRequired()]
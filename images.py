@@ -0,0 +1,330 @@
+import base64
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from functools import lru_cache
+from markupsafe import Markup, escape
+from flask import redirect, send_file, abort
+from app import app
+import jobs
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+#----------------------------------------------------------------------------#
+# Image proxy.
+#----------------------------------------------------------------------------#
+
+# Venue and artist images are external URLs entered by users, often large
+# originals on slow hosts. Templates show them with {{ image(url, 'tile') }},
+# which links /images/<size>/<signature>/<url> instead of the URL itself.
+# The first request for an image fetches it once, stores every size below
+# in IMAGE_CACHE_DIR, and all later requests are served from there with a
+# long max-age and an ETag. Images entered on the forms are fetched by a job
+# right after the submission instead, see jobs.py.
+#
+# The cache is content addressed: resized copies are named after the hash of
+# the original (ab/ab12...-tile.jpg), and urls/ maps the hash of each URL
+# to it, so the same picture under several URLs is stored once. Hits touch
+# the files they serve (at most hourly), and once the cache outgrows
+# IMAGE_CACHE_MAX_BYTES the least recently touched files are deleted.
+#
+# Only signed URLs are fetched, so /images cannot be used to fetch arbitrary
+# URLs, and hosts on private addresses are refused, redirects included; the
+# address checked is the one connected to. When an image cannot be fetched
+# or read, the browser is redirected to the original URL, and the URL is not
+# tried again for FAILURE_MAX_AGE seconds. Without Pillow, or with
+# IMAGE_PROXY=0, templates link the original URLs.
+
+# bounding boxes, from the tile and detail image CSS, and for 2x displays
+SIZES = {
+    'tile': (360, 200),
+    'tile-2x': (720, 400),
+    'detail': (560, 500),
+    'detail-2x': (1120, 1000),
+}
+
+MAX_AGE = 30 * 24 * 60 * 60
+TOUCH_INTERVAL = 60 * 60
+FAILURE_MAX_AGE = 5 * 60
+
+class ImageError(Exception):
+    pass
+
+#  Links
+#  ----------------------------------------------------------------
+
+@lru_cache(maxsize=4096)
+def sign(url):
+    digest = hmac.new(app.config['IMAGE_PROXY_KEY'], url.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode()
+
+def proxied(url, size):
+    if not url or Image is None or not app.config['IMAGE_PROXY']:
+        return url
+    encoded = base64.urlsafe_b64encode(url.encode()).decode().rstrip('=')
+    return f'/images/{size}/{sign(url)}/{encoded}'
+
+def image(url, size, alt):
+    if not url:
+        return Markup(f'<img alt="{escape(alt)}" />')
+    src = proxied(url, size)
+    srcset = ''
+    if src != url and size + '-2x' in SIZES:
+        srcset = f' srcset="{escape(proxied(url, size + "-2x"))} 2x"'
+    return Markup(f'<img src="{escape(src)}"{srcset} alt="{escape(alt)}" />')
+
+app.jinja_env.globals.update(image=image)
+
+#  Fetching
+#  ----------------------------------------------------------------
+
+def check_url(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f'not an http(s) URL: {url}')
+
+def resolve(host, port):
+    # the address to connect to, once every address of the host is known to
+    # be public
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ImageError(f'cannot resolve {host}: {e}')
+    if not app.config['IMAGE_PROXY_ALLOW_PRIVATE']:
+        for *_, address in addresses:
+            if not ipaddress.ip_address(address[0].split('%')[0]).is_global:
+                raise ImageError(f'{host} is a private address')
+    return addresses[0][4][0]
+
+class Pinned:
+    # connects to the address resolve() checked rather than letting the
+    # socket resolve the host again, which a rebinding DNS server could
+    # answer with a private address; the Host header and TLS server name
+    # stay the host's
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = self.create_connection
+
+    def create_connection(self, address, timeout, source_address=None):
+        host, port = address
+        return socket.create_connection((resolve(host, port), port), timeout, source_address)
+
+class PinnedHTTPConnection(Pinned, http.client.HTTPConnection):
+    pass
+
+class PinnedHTTPSConnection(Pinned, http.client.HTTPSConnection):
+    pass
+
+class PinnedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PinnedHTTPConnection, req)
+
+class PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PinnedHTTPSConnection, req, context=self._context)
+
+class CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    # redirects are followed to http(s) URLs only, fetched through the same
+    # pinned connections
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+# no proxies from the environment: the connection must go to the address
+# that was checked
+opener = urllib.request.build_opener(urllib.request.ProxyHandler({}), PinnedHTTPHandler,
+                                     PinnedHTTPSHandler, CheckedRedirects)
+
+def fetch(url):
+    check_url(url)
+    limit = app.config['IMAGE_FETCH_MAX_BYTES']
+    request = urllib.request.Request(url, headers={'User-Agent': 'Fyyur image proxy'})
+    try:
+        with opener.open(request, timeout=app.config['IMAGE_FETCH_TIMEOUT']) as response:
+            content = response.read(limit + 1)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        raise ImageError(f'cannot fetch {url}: {e}')
+    if len(content) > limit:
+        raise ImageError(f'{url} is larger than {limit} bytes')
+    return content
+
+def resize(content):
+    # {size: (bytes, extension)} for every size, from one decoding of the
+    # original; opaque images are saved as JPEG, others as PNG
+    try:
+        original = Image.open(io.BytesIO(content))
+        # JPEGs are decoded directly at a fraction of their size, as long as
+        # it stays above the largest size
+        original.draft('RGB', max(SIZES.values()))
+        original = ImageOps.exif_transpose(original)
+        alpha = original.mode in ('RGBA', 'LA', 'PA') or 'transparency' in original.info
+        original = original.convert('RGBA' if alpha else 'RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(f'not an image: {e}')
+
+    # every size fits in the largest box, so they are all resized from a
+    # copy reduced to that box rather than from the original
+    largest = original.copy()
+    largest.thumbnail(max(SIZES.values()), Image.LANCZOS)
+    resized = {}
+    for size, box in SIZES.items():
+        current = largest.copy()
+        current.thumbnail(box, Image.LANCZOS)
+        output = io.BytesIO()
+        if alpha:
+            current.save(output, 'PNG', optimize=True)
+        else:
+            current.save(output, 'JPEG', quality=82, optimize=True, progressive=True)
+        resized[size] = (output.getvalue(), 'png' if alpha else 'jpg')
+    return resized
+
+#  Cache
+#  ----------------------------------------------------------------
+
+lock = threading.Lock()
+usage = None
+# URLs that could not be fetched or read, with when to try them again
+failures = {}
+
+def cache_path(*parts):
+    return os.path.join(app.config['IMAGE_CACHE_DIR'], *parts)
+
+def url_index(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return cache_path('urls', key[:2], key)
+
+def image_path(digest, size, extension):
+    return cache_path(digest[:2], f'{digest}-{size}.{extension}')
+
+def store(path, content):
+    # written under a temporary name and renamed, so a concurrent request
+    # never serves a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(content)
+    os.replace(temporary, path)
+    return len(content)
+
+def cached_files():
+    for directory, _, files in os.walk(app.config['IMAGE_CACHE_DIR']):
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+def evict(written):
+    # the cache size is counted once per process and then kept up to date
+    # from the writes; the cache is only walked again when it is over the
+    # limit, and then shrunk to 90% of it
+    global usage
+    limit = app.config['IMAGE_CACHE_MAX_BYTES']
+    with lock:
+        if usage is None:
+            usage = sum(size for _, size, _ in cached_files())
+        else:
+            usage += written
+        if usage <= limit:
+            return
+        files = sorted(cached_files())
+        usage = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if usage <= limit * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            usage -= size
+
+def lookup(url, size):
+    # (path, digest) of the cached image, None if it is not cached
+    try:
+        with open(url_index(url)) as file:
+            digest, extension = file.read().split()
+        path = image_path(digest, size, extension)
+        modified = os.stat(path).st_mtime
+    except (FileNotFoundError, ValueError):
+        return None
+    if time.time() - modified > TOUCH_INTERVAL:
+        os.utime(path)
+    return path, digest
+
+def cached(url, size):
+    found = lookup(url, size)
+    if found is not None:
+        return found
+    if failures.get(url, 0) > time.monotonic():
+        raise ImageError(f'{url} failed recently')
+
+    try:
+        content = fetch(url)
+        resized = resize(content)
+    except ImageError:
+        if len(failures) > 10000:
+            failures.clear()
+        failures[url] = time.monotonic() + FAILURE_MAX_AGE
+        raise
+    failures.pop(url, None)
+    digest = hashlib.sha256(content).hexdigest()
+    extension = resized[size][1]
+    written = 0
+    for name, (data, _) in resized.items():
+        written += store(image_path(digest, name, extension), data)
+    written += store(url_index(url), f'{digest} {extension}'.encode())
+    evict(written)
+    return image_path(digest, size, extension), digest
+
+@jobs.job('resize-image')
+def resize_job(url):
+    # an image entered on a form is resized before its first view; workers
+    # of other processes must share IMAGE_CACHE_DIR
+    try:
+        cached(url, 'tile')
+    except ImageError as e:
+        app.logger.warning('image proxy: %s', e)
+
+def resize_later(url):
+    if url and Image is not None and app.config['IMAGE_PROXY']:
+        jobs.enqueue('resize-image', url, key=f'image:{url}')
+
+#  Serving
+#  ----------------------------------------------------------------
+
+@app.route('/images/<size>/<signature>/<encoded>')
+def proxy(size, signature, encoded):
+    if Image is None or size not in SIZES:
+        abort(404)
+    try:
+        url = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        abort(404)
+    if not hmac.compare_digest(signature, sign(url)):
+        abort(404)
+
+    try:
+        path, digest = cached(url, size)
+    except ImageError as e:
+        app.logger.warning('image proxy: %s', e)
+        response = redirect(url)
+        response.cache_control.max_age = FAILURE_MAX_AGE
+        return response
+
+    response = send_file(path, max_age=MAX_AGE, etag=f'{digest}-{size}')
+    response.cache_control.public = True
+    return response
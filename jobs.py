@@ -0,0 +1,297 @@
+import heapq
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from app import app
+
+#----------------------------------------------------------------------------#
+# Background jobs.
+#----------------------------------------------------------------------------#
+
+# The work that follows a write without being part of it (dropping cached
+# pages, resizing a new image, refreshing matches) runs as jobs, so that a
+# submission only waits for its own commit. Functions are registered as
+# jobs with @job('name') and queued with enqueue('name', *args), the
+# arguments being JSON values.
+#
+# JOB_BACKEND selects where jobs run:
+#   thread       worker threads of the process that queued them
+#   redis        a queue shared by every process, in Redis (needs the redis
+#                package and JOB_REDIS_URL), run by `flask run-jobs`
+#                processes
+#   local-redis  the redis queue on an in-process stand-in, run by worker
+#                threads, for development without Redis
+#   sync         at once, inside the request
+# Jobs queued as local (e.g. dropping pages from the per-process memory
+# cache) always run on the threads of the process that queued them.
+#
+# A failed job is tried again after JOB_RETRY_DELAY seconds, doubled at
+# each attempt, up to JOB_MAX_ATTEMPTS attempts; after that it is logged and
+# kept with the last failures. Jobs must be idempotent, as one may run again
+# after failing halfway. A job queued with a key is not queued again while
+# another with the same key waits to run, so a burst of writes asking for
+# the same refresh gets one. Jobs can be delayed, which with a key collects
+# the requests of the whole delay into one run.
+#
+# Queue depth, throughput and failures are served at /internal/jobs.
+
+registry = {}
+
+def job(name):
+    def decorator(function):
+        registry[name] = function
+        return function
+    return decorator
+
+def new_job(name, args, key):
+    return {'id': uuid.uuid4().hex, 'name': name, 'args': list(args), 'key': key,
+            'attempt': 1, 'queued_at': time.time()}
+
+def retry_delay(attempt):
+    return app.config['JOB_RETRY_DELAY'] * 2 ** (attempt - 1)
+
+def run(queue, job):
+    # runs one job taken off the queue, and queues it again when it fails
+    if job['key'] is not None:
+        # later requests for the same work need a run of their own
+        queue.release(job['key'])
+    start = time.perf_counter()
+    try:
+        with app.app_context():
+            registry[job['name']](*job['args'])
+    except Exception as e:
+        queue.count('failed_attempts')
+        if job['attempt'] >= app.config['JOB_MAX_ATTEMPTS']:
+            app.logger.exception('job %s %s failed %d times, giving up',
+                                 job['name'], job['args'], job['attempt'])
+            queue.give_up({**job, 'error': repr(e), 'failed_at': time.time()})
+        else:
+            app.logger.warning('job %s %s failed (attempt %d): %r',
+                               job['name'], job['args'], job['attempt'], e)
+            queue.put({**job, 'attempt': job['attempt'] + 1}, retry_delay(job['attempt']))
+    else:
+        queue.count('done')
+    finally:
+        queue.timed(time.perf_counter() - start)
+
+
+class Stats:
+    # counters of one queue, for the process
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'queued': 0, 'deduplicated': 0, 'done': 0, 'failed_attempts': 0,
+                       'given_up': 0, 'seconds_total': 0.0, 'seconds_max': 0.0}
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counts[counter] += n
+
+    def timed(self, seconds):
+        with self.lock:
+            self.counts['seconds_total'] += seconds
+            self.counts['seconds_max'] = max(self.counts['seconds_max'], seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class ThreadQueue(Stats):
+    # jobs held in the process, ordered by when they are due, and run by
+    # JOB_WORKERS daemon threads started with the first job
+
+    def __init__(self, workers):
+        super().__init__()
+        self.workers = workers
+        self.jobs = []
+        self.order = itertools.count()
+        self.waiting_keys = set()
+        self.failures = deque(maxlen=100)
+        self.running = 0
+        self.condition = threading.Condition(self.lock)
+        self.threads = []
+
+    def add(self, job, delay=0):
+        with self.condition:
+            if job['key'] is not None:
+                if job['key'] in self.waiting_keys:
+                    self.counts['deduplicated'] += 1
+                    return False
+                self.waiting_keys.add(job['key'])
+            self.counts['queued'] += 1
+        self.put(job, delay)
+        return True
+
+    def put(self, job, delay=0):
+        with self.condition:
+            heapq.heappush(self.jobs, (time.monotonic() + delay, next(self.order), job))
+            self.condition.notify()
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True, name='job')
+                self.threads.append(thread)
+                thread.start()
+
+    def release(self, key):
+        with self.condition:
+            self.waiting_keys.discard(key)
+
+    def give_up(self, job):
+        self.count('given_up')
+        self.failures.append(job)
+
+    def take(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.jobs and self.jobs[0][0] <= now:
+                    self.running += 1
+                    return heapq.heappop(self.jobs)[2]
+                self.condition.wait(self.jobs[0][0] - now if self.jobs else None)
+
+    def work(self):
+        while True:
+            job = self.take()
+            try:
+                run(self, job)
+            finally:
+                with self.condition:
+                    self.running -= 1
+
+    def status(self):
+        with self.condition:
+            now = time.monotonic()
+            due = sum(1 for due_at, _, _ in self.jobs if due_at <= now)
+            status = {'depth': due, 'delayed': len(self.jobs) - due, 'running': self.running}
+        return {**status, **self.snapshot(), 'failures': list(self.failures)[-10:]}
+
+
+class RedisQueue:
+    # jobs in a Redis list (due) and sorted set (delayed, scored by when they
+    # are due), shared by every process; keys of waiting jobs are kept as
+    # Redis keys expiring after JOB_KEY_TTL. The counters are Redis hash
+    # fields, totals over all processes.
+
+    def __init__(self, client, workers, prefix='fyyur:jobs:'):
+        self.client = client
+        self.workers = workers
+        self.prefix = prefix
+        self.threads = []
+
+    def add(self, job, delay=0):
+        if job['key'] is not None and not self.client.set(
+                self.prefix + 'key:' + job['key'], job['id'], nx=True, ex=app.config['JOB_KEY_TTL']):
+            self.count('deduplicated')
+            return False
+        self.count('queued')
+        self.put(job, delay)
+        return True
+
+    def put(self, job, delay=0):
+        payload = json.dumps(job)
+        if delay:
+            self.client.zadd(self.prefix + 'delayed', {payload: time.time() + delay})
+        else:
+            self.client.lpush(self.prefix + 'due', payload)
+
+    def release(self, key):
+        self.client.delete(self.prefix + 'key:' + key)
+
+    def count(self, counter, n=1):
+        self.client.hincrby(self.prefix + 'stats', counter, n)
+
+    def timed(self, seconds):
+        self.client.hincrbyfloat(self.prefix + 'stats', 'seconds_total', seconds)
+
+    def give_up(self, job):
+        self.count('given_up')
+        self.client.lpush(self.prefix + 'failures', json.dumps(job))
+        self.client.ltrim(self.prefix + 'failures', 0, 99)
+
+    def promote(self):
+        # moves the delayed jobs that are due to the list; with several
+        # workers at it, only the one that removes a job moves it
+        for payload in self.client.zrangebyscore(self.prefix + 'delayed', 0, time.time()):
+            if self.client.zrem(self.prefix + 'delayed', payload):
+                self.client.lpush(self.prefix + 'due', payload)
+
+    def work(self):
+        while True:
+            self.promote()
+            taken = self.client.brpop(self.prefix + 'due', timeout=1)
+            if taken is not None:
+                run(self, json.loads(taken[1]))
+
+    def start(self):
+        # worker threads of this process, for local-redis
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.work, daemon=True, name='job')
+            self.threads.append(thread)
+            thread.start()
+
+    def status(self):
+        counts = {key.decode() if isinstance(key, bytes) else key: float(value)
+                  for key, value in self.client.hgetall(self.prefix + 'stats').items()}
+        return {'depth': self.client.llen(self.prefix + 'due'),
+                'delayed': self.client.zcard(self.prefix + 'delayed'),
+                **counts,
+                'failures': [json.loads(payload)
+                             for payload in self.client.lrange(self.prefix + 'failures', 0, 9)]}
+
+
+def create_queue(config):
+    backend = config['JOB_BACKEND']
+    if backend == 'thread':
+        return ThreadQueue(config['JOB_WORKERS'])
+    if backend == 'redis':
+        import redis
+        return RedisQueue(redis.Redis.from_url(config['JOB_REDIS_URL']), config['JOB_WORKERS'])
+    if backend == 'local-redis':
+        from cache import LocalRedis
+        return RedisQueue(LocalRedis(), config['JOB_WORKERS'])
+    if backend == 'sync':
+        return None
+    raise ValueError(f'Unknown JOB_BACKEND {backend!r}')
+
+queue = None
+local_queue = None
+lock = threading.Lock()
+
+def queues():
+    # (queue, queue for local jobs), created on first use
+    global queue, local_queue
+    with lock:
+        if local_queue is None:
+            queue = create_queue(app.config)
+            local_queue = queue if isinstance(queue, ThreadQueue) else ThreadQueue(app.config['JOB_WORKERS'])
+    return queue, local_queue
+
+def enqueue(name, *args, key=None, delay=0, local=False):
+    # queues the job, or with JOB_BACKEND=sync runs it at once; returns False
+    # when a job with the same key was already waiting
+    if app.config['JOB_BACKEND'] == 'sync':
+        # as with the other backends, a failing job is logged and does not
+        # fail the caller, whose write has already committed
+        try:
+            registry[name](*args)
+        except Exception:
+            app.logger.exception('job %s %s failed', name, list(args))
+        return True
+    shared, own = queues()
+    target = own if local else shared
+    added = target.add(new_job(name, args, key), delay)
+    if target is shared and app.config['JOB_BACKEND'] == 'local-redis':
+        shared.start()
+    return added
+
+def status():
+    if app.config['JOB_BACKEND'] == 'sync':
+        return {'backend': 'sync'}
+    shared, own = queues()
+    status = {'backend': app.config['JOB_BACKEND'], **shared.status()}
+    if own is not shared:
+        status['local'] = own.status()
+    return status
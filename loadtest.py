@@ -0,0 +1,152 @@
+#----------------------------------------------------------------------------#
+# Load test.
+#----------------------------------------------------------------------------#
+
+# Drives concurrent GET requests against a running Fyyur server and reports
+# throughput, latency percentiles and the server's connection pool metrics.
+# Run the server against a local PostgreSQL with the pool settings under
+# test, e.g.
+#
+#   DB_POOL_SIZE=5 DB_MAX_OVERFLOW=0 gunicorn -w 2 --threads 16 app:app
+#   python loadtest.py --url http://127.0.0.1:8000 --concurrency 32
+#
+# and repeat with different DB_POOL_SIZE / DB_MAX_OVERFLOW values. A pool is
+# big enough when checkout waits stay near zero at the target concurrency;
+# anything bigger only costs server connections.
+#
+# Given several --url, the servers are loaded one after the other with the
+# same settings and compared, e.g. sequential against parallel page queries
+# at equal worker counts:
+#
+#   gunicorn -w 2 --threads 8 -b :8000 app:app
+#   PARALLEL_QUERIES=8 gunicorn -w 2 --threads 8 -b :8001 app:app
+#   python loadtest.py --url http://127.0.0.1:8000 --url http://127.0.0.1:8001
+
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PATHS = [
+    '/venues',
+    '/artists',
+    '/shows',
+    '/venues/1',
+    '/artists/1',
+    '/api/v1/shows',
+]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def fetch(url):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        status = error.code
+    except OSError:
+        status = None
+    return status, time.perf_counter() - start
+
+def run(base_url, paths, concurrency, duration):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset):
+        nonlocal errors
+        i = offset
+        while time.monotonic() < deadline:
+            status, elapsed = fetch(base_url + paths[i % len(paths)])
+            i += 1
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset in range(concurrency):
+            executor.submit(worker, offset)
+    elapsed = time.monotonic() - start
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+    }
+
+def pool_metrics(base_url):
+    try:
+        with urllib.request.urlopen(base_url + '/internal/pool', timeout=5) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None
+
+def report(base_url, paths, concurrency, duration):
+    before = pool_metrics(base_url)
+    result = run(base_url, paths, concurrency, duration)
+    after = pool_metrics(base_url)
+
+    print(f"{result['requests']} requests, {result['errors']} errors, "
+          f"{result['throughput']:.1f} req/s at concurrency {concurrency}")
+    print(f"latency p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, "
+          f"p99 {result['p99_ms']:.1f} ms, mean {result['mean_ms']:.1f} ms")
+
+    if before is not None and after is not None:
+        checkouts = after['checkouts'] - before['checkouts']
+        wait = after['wait_seconds_total'] - before['wait_seconds_total']
+        print(f"pool: {checkouts} checkouts, "
+              f"{wait / checkouts * 1000 if checkouts else 0:.2f} ms average wait, "
+              f"{after['wait_seconds_max'] * 1000:.1f} ms max wait, "
+              f"{after['timeouts'] - before['timeouts']} timeouts, "
+              f"{after['invalidations'] - before['invalidations']} invalidations, "
+              f"overflow {after.get('overflow')}")
+        print('(pool metrics are per server process; with several workers each '
+              'request to /internal/pool samples one of them)')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running Fyyur server.')
+    parser.add_argument('--url', action='append', dest='urls',
+                        help='server to load, may be repeated to compare servers '
+                             '(default: http://127.0.0.1:5000)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--path', action='append', dest='paths',
+                        help='path to request, may be repeated (default: listings and detail pages)')
+    args = parser.parse_args()
+    base_urls = [url.rstrip('/') for url in args.urls or ['http://127.0.0.1:5000']]
+
+    results = []
+    for base_url in base_urls:
+        if len(base_urls) > 1:
+            print(f'== {base_url}')
+        results.append(report(base_url, args.paths or DEFAULT_PATHS, args.concurrency, args.duration))
+
+    if len(base_urls) > 1:
+        first = results[0]
+        print(f"{'server':32} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'vs first':>9}")
+        for base_url, result in zip(base_urls, results):
+            ratio = result['throughput'] / first['throughput'] if first['throughput'] else 0.0
+            print(f"{base_url:32} {result['throughput']:8.1f} {result['p50_ms']:8.1f} "
+                  f"{result['p95_ms']:8.1f} {ratio:8.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+from datetime import datetime, timedelta
+from sqlalchemy.dialects import sqlite
+from app import app, db
+from models import Venue, Artist, Show, Match, MatchState
+import cache
+import jobs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#----------------------------------------------------------------------------#
+# Artist-venue matching.
+#----------------------------------------------------------------------------#
+
+# Artists seeking a venue are matched with venues seeking talent. A pair
+# scores by genre overlap (Jaccard of their genre sets), locality (same
+# city, or else same state) and past co-booking (shows of the artist at the
+# venue), with the weights below. Pairs without a genre in common do not
+# match.
+#
+# The matches table holds, for every candidate artist, its best
+# MATCHES_PER_ENTITY venues and, for every candidate venue, its best
+# MATCHES_PER_ENTITY artists; the detail pages read their top rows from it.
+# It is filled by `flask refresh-matches`, meant to run every few minutes
+# from cron, and by a job queued by the submissions, which runs
+# MATCHES_REFRESH_DELAY seconds after the first of a burst of writes (see
+# jobs.py). Each run only recomputes what changed since the previous one
+# (less MATCHES_REFRESH_OVERLAP), found through updated_at: the artists and
+# venues edited and those of new or moved shows, plus the entities that
+# listed one of them. Deleted venues and artists mark those that listed them
+# as changed (see deletion.py); deleted shows are picked up by
+# `flask refresh-matches --full`, e.g. nightly.
+#
+# Scores are computed with NumPy, for a batch of artists against a batch of
+# venues at once: genres are bitsets (one bit per genre, in uint64 words)
+# counted with bitwise_count, which needs NumPy 2. Only the refresh needs
+# NumPy; the pages read the table.
+
+GENRE_WEIGHT = 0.6
+LOCAL_WEIGHT = 0.25
+BOOKED_WEIGHT = 0.15
+# co-bookings count up to this many shows
+BOOKED_SHOWS = 3
+# scores computed per batch, bounding the memory a batch takes
+BATCH_CELLS = 2 ** 22
+
+def per_entity():
+    return app.config['MATCHES_PER_ENTITY']
+
+#  Reading
+#  ----------------------------------------------------------------
+
+def suggested(owner_column, other, other_column, owner_id):
+    return db.session.query(other.id, other.name, other.city, other.state, other.image_link,
+                            Match.score) \
+        .join(other, other_column == other.id) \
+        .filter(owner_column == owner_id) \
+        .order_by(Match.score.desc(), other.id) \
+        .limit(per_entity()) \
+        .all()
+
+def venues_for(artist_id):
+    return suggested(Match.artist_id, Venue, Match.venue_id, artist_id)
+
+def artists_for(venue_id):
+    return suggested(Match.venue_id, Artist, Match.artist_id, venue_id)
+
+#  Scoring
+#  ----------------------------------------------------------------
+
+class Side:
+    # the candidate artists or venues, as arrays indexed alike
+
+    def __init__(self, model, seeking_column, genre_bits, places, states):
+        rows = db.session.query(model.id, model.genres, model.city, model.state) \
+            .filter(seeking_column.is_(True)) \
+            .order_by(model.id) \
+            .all()
+        self.ids = np.array([row.id for row in rows], dtype=np.int64)
+        self.rows = rows
+        self.place_codes = np.array([places.setdefault((row.city, row.state), len(places))
+                                     for row in rows], dtype=np.int32)
+        self.state_codes = np.array([states.setdefault(row.state, len(states)) for row in rows],
+                                    dtype=np.int32)
+        for row in rows:
+            for genre in row.genres or ():
+                genre_bits.setdefault(genre, len(genre_bits))
+
+    def encode_genres(self, genre_bits):
+        words = max(1, (len(genre_bits) + 63) // 64)
+        genres = np.zeros((len(self.ids), words), dtype=np.uint64)
+        for i, row in enumerate(self.rows):
+            for genre in row.genres or ():
+                bit = genre_bits[genre]
+                genres[i, bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+        self.genres = genres
+        self.genre_counts = np.bitwise_count(genres).sum(axis=1, dtype=np.uint16)
+        del self.rows
+
+    def lookup(self, ids):
+        # (positions, found) of the given ids among the candidates; found is
+        # False for the ids that are not candidates
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return positions, self.ids[positions] == ids
+
+    def positions(self, ids):
+        positions, found = self.lookup(sorted(ids))
+        return positions[found]
+
+
+class Candidates:
+
+    def __init__(self):
+        genre_bits = {}
+        places = {}
+        states = {}
+        self.artists = Side(Artist, Artist.seeking_venue, genre_bits, places, states)
+        self.venues = Side(Venue, Venue.seeking_talent, genre_bits, places, states)
+        self.artists.encode_genres(genre_bits)
+        self.venues.encode_genres(genre_bits)
+
+        # shows of candidate artists at candidate venues, as positions
+        booked = db.session.query(Show.artist_id, Show.venue_id, db.func.count(Show.id)) \
+            .join(Artist, Show.artist_id == Artist.id) \
+            .join(Venue, Show.venue_id == Venue.id) \
+            .filter(Artist.seeking_venue.is_(True), Venue.seeking_talent.is_(True)) \
+            .group_by(Show.artist_id, Show.venue_id) \
+            .all()
+        pairs = np.array(booked, dtype=np.int64).reshape(-1, 3)
+        self.booked_artists = np.searchsorted(self.artists.ids, pairs[:, 0])
+        self.booked_venues = np.searchsorted(self.venues.ids, pairs[:, 1])
+        self.booked_scores = (BOOKED_WEIGHT * np.minimum(pairs[:, 2], BOOKED_SHOWS)
+                              / BOOKED_SHOWS).astype(np.float32)
+
+    def scores(self, artists, venues):
+        # len(artists) x len(venues) scores, given candidate positions
+        a, v = self.artists, self.venues
+        common = np.zeros((len(artists), len(venues)), dtype=np.uint8)
+        for word in range(a.genres.shape[1]):
+            common += np.bitwise_count(a.genres[artists, word][:, None]
+                                       & v.genres[venues, word][None, :])
+        # |A or B| = |A| + |B| - |A and B|
+        either = a.genre_counts[artists][:, None] + v.genre_counts[venues][None, :] - common
+        scores = np.float32(GENRE_WEIGHT) * common / np.maximum(either, 1, dtype=np.float32)
+
+        # half the weight for the same state, all of it for the same city
+        local = np.float32(LOCAL_WEIGHT / 2)
+        scores += local * (a.state_codes[artists][:, None] == v.state_codes[venues][None, :])
+        scores += local * (a.place_codes[artists][:, None] == v.place_codes[venues][None, :])
+
+        # co-bookings falling inside this batch
+        rows = np.full(len(a.ids), -1)
+        rows[artists] = np.arange(len(artists))
+        columns = np.full(len(v.ids), -1)
+        columns[venues] = np.arange(len(venues))
+        inside = (rows[self.booked_artists] >= 0) & (columns[self.booked_venues] >= 0)
+        scores[rows[self.booked_artists[inside]], columns[self.booked_venues[inside]]] \
+            += self.booked_scores[inside]
+
+        scores[common == 0] = 0
+        return scores
+
+    def best(self, artists, venues, axis):
+        # (artist position, venue position, score) of the best pairs of each
+        # row (axis=1, per artist) or column (axis=0, per venue), batched
+        # over the side being ranked
+        ranked, others = (artists, venues) if axis == 1 else (venues, artists)
+        size = max(1, BATCH_CELLS // max(len(others), 1))
+        k = min(per_entity(), len(others))
+        for start in range(0, len(ranked), size):
+            batch = ranked[start:start + size]
+            if axis == 1:
+                scores = self.scores(batch, others)
+            else:
+                scores = self.scores(others, batch).T
+            if k == 0:
+                continue
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for row, columns in zip(range(len(batch)), top):
+                for column in columns:
+                    score = scores[row, column]
+                    if score > 0:
+                        pair = (batch[row], others[column]) if axis == 1 else (others[column], batch[row])
+                        yield (*pair, float(score))
+
+    def beating(self, artists, venues, thresholds, axis):
+        # pairs scoring above the threshold of the venue (axis=1) or artist
+        # (axis=0) they would join
+        size = max(1, BATCH_CELLS // max(len(venues) if axis == 1 else len(artists), 1))
+        changed = artists if axis == 1 else venues
+        for start in range(0, len(changed), size):
+            batch = changed[start:start + size]
+            if axis == 1:
+                scores = self.scores(batch, venues)
+                found = np.argwhere((scores > 0) & (scores > thresholds[None, :]))
+                for row, column in found:
+                    yield batch[row], venues[column], float(scores[row, column])
+            else:
+                scores = self.scores(artists, batch)
+                found = np.argwhere((scores > 0) & (scores > thresholds[:, None]))
+                for row, column in found:
+                    yield artists[row], batch[column], float(scores[row, column])
+
+#  Refreshing
+#  ----------------------------------------------------------------
+
+def state(connection):
+    query = db.select(MatchState.refreshed_at).where(MatchState.id == 1).with_for_update()
+    return connection.execute(query).scalar()
+
+def set_refreshed_at(connection, now):
+    if connection.execute(db.update(MatchState.__table__)
+                          .where(MatchState.id == 1)
+                          .values(refreshed_at=now)).rowcount == 0:
+        connection.execute(db.insert(MatchState.__table__).values(id=1, refreshed_at=now))
+
+def changed_since(model, owner_column, since):
+    edited = db.session.query(model.id).filter(model.updated_at > since)
+    booked = db.session.query(owner_column).filter(Show.updated_at > since)
+    # deleted entities count as changed until they are purged
+    return {id for id, in edited.union(booked).execution_options(include_deleted=True)}
+
+def kth_scores(owner_column, side):
+    # the k-th best score listed for each candidate, 0 where fewer are listed
+    ranked = db.select(owner_column.label('owner_id'), Match.score,
+                       db.func.row_number().over(partition_by=owner_column,
+                                                 order_by=Match.score.desc()).label('rank')) \
+        .subquery()
+    rows = db.session.execute(db.select(ranked.c.owner_id, ranked.c.score)
+                              .where(ranked.c.rank == per_entity())).all()
+    thresholds = np.zeros(len(side.ids), dtype=np.float32)
+    positions, found = side.lookup([owner_id for owner_id, _ in rows])
+    scores = np.array([score for _, score in rows], dtype=np.float32)
+    thresholds[positions[found]] = scores[found]
+    return thresholds
+
+def upsert(rows, now):
+    if not rows:
+        return
+    if db.engine.dialect.name == 'postgresql':
+        # one statement over arrays of the values; an executemany would be
+        # a round trip per row with psycopg2
+        (artist_ids, venue_ids), scores = zip(*rows), list(rows.values())
+        db.session.execute(db.text(
+            'INSERT INTO matches (artist_id, venue_id, score, updated_at) '
+            'SELECT artist_id, venue_id, score, :now '
+            'FROM unnest(CAST(:artist_ids AS integer[]), CAST(:venue_ids AS integer[]), '
+            'CAST(:scores AS double precision[])) AS new (artist_id, venue_id, score) '
+            'ON CONFLICT (artist_id, venue_id) '
+            'DO UPDATE SET score = excluded.score, updated_at = excluded.updated_at'),
+            {'now': now, 'artist_ids': list(artist_ids), 'venue_ids': list(venue_ids),
+             'scores': scores})
+        return
+
+    statement = sqlite.insert(Match.__table__)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['artist_id', 'venue_id'],
+        set_={'score': statement.excluded.score, 'updated_at': statement.excluded.updated_at}),
+        [{'artist_id': artist_id, 'venue_id': venue_id, 'score': score, 'updated_at': now}
+         for (artist_id, venue_id), score in rows.items()])
+
+def past_best(owner_column, other_column, owner_ids):
+    # (artist_id, venue_id) of the rows ranked past MATCHES_PER_ENTITY in the
+    # lists of the given artists or venues
+    if not owner_ids:
+        return set()
+    ranked = db.select(Match.artist_id, Match.venue_id,
+                       db.func.row_number().over(partition_by=owner_column,
+                                                 order_by=(Match.score.desc(), other_column))
+                       .label('rank')) \
+        .where(owner_column.in_(owner_ids)) \
+        .subquery()
+    return set(db.session.execute(db.select(ranked.c.artist_id, ranked.c.venue_id)
+                                  .where(ranked.c.rank > per_entity())).all())
+
+def trim(artist_ids, venue_ids):
+    # the lists of these artists and venues may have gained rows; a row that
+    # fell out of one list is deleted unless it is still among the best of
+    # the other side's list
+    past_artists = past_best(Match.artist_id, Match.venue_id, artist_ids)
+    past_venues = past_best(Match.venue_id, Match.artist_id, venue_ids)
+    stale = past_artists & past_best(Match.venue_id, Match.artist_id,
+                                     {venue_id for _, venue_id in past_artists}) \
+        | past_venues & past_best(Match.artist_id, Match.venue_id,
+                                  {artist_id for artist_id, _ in past_venues})
+    if stale:
+        db.session.execute(db.delete(Match).where(
+            db.tuple_(Match.artist_id, Match.venue_id).in_(list(stale))))
+
+def refresh(full=False, now=None):
+    # returns the ids of the artists and of the venues whose matches may
+    # have changed
+    if np is None:
+        raise RuntimeError('refreshing matches needs NumPy')
+    now = now or datetime.now()
+    connection = db.session.connection()
+    refreshed_at = state(connection)
+    incremental = not full and refreshed_at is not None
+    if incremental:
+        # updated_at is stamped at the flush, so a write stamped before the
+        # previous run read may have committed after it; look back further
+        since = refreshed_at - timedelta(seconds=app.config['MATCHES_REFRESH_OVERLAP'])
+        changed_artists = changed_since(Artist, Show.artist_id, since)
+        changed_venues = changed_since(Venue, Show.venue_id, since)
+        if not changed_artists and not changed_venues:
+            set_refreshed_at(connection, now)
+            db.session.commit()
+            return set(), set()
+
+    candidates = Candidates()
+    artists, venues = candidates.artists, candidates.venues
+
+    if not incremental:
+        db.session.execute(db.delete(Match))
+        changed_artists, changed_venues = set(artists.ids.tolist()), set(venues.ids.tolist())
+        rerank_artists, rerank_venues = changed_artists, changed_venues
+    else:
+        # the rows of changed entities are dropped; the entities that listed
+        # one of them lose a member and are ranked again too
+        listing_artists = {id for id, in db.session.query(Match.artist_id).distinct()
+                           .filter(Match.venue_id.in_(changed_venues))} if changed_venues else set()
+        listing_venues = {id for id, in db.session.query(Match.venue_id).distinct()
+                          .filter(Match.artist_id.in_(changed_artists))} if changed_artists else set()
+        db.session.execute(db.delete(Match).where(db.or_(Match.artist_id.in_(changed_artists),
+                                                         Match.venue_id.in_(changed_venues))))
+        rerank_artists = changed_artists | listing_artists
+        rerank_venues = changed_venues | listing_venues
+
+    all_artists = np.arange(len(artists.ids))
+    all_venues = np.arange(len(venues.ids))
+    ranked_artists = artists.positions(rerank_artists)
+    ranked_venues = venues.positions(rerank_venues)
+
+    found = {}
+    def add(pairs):
+        for artist, venue, score in pairs:
+            found[int(artists.ids[artist]), int(venues.ids[venue])] = score
+
+    add(candidates.best(ranked_artists, all_venues, axis=1))
+    add(candidates.best(all_artists, ranked_venues, axis=0))
+
+    if incremental:
+        # changed entities may now belong in lists that were not ranked
+        # again: those where they beat the k-th best
+        thresholds = kth_scores(Match.venue_id, venues)
+        thresholds[ranked_venues] = np.inf
+        add(candidates.beating(artists.positions(changed_artists), all_venues, thresholds, axis=1))
+        thresholds = kth_scores(Match.artist_id, artists)
+        thresholds[ranked_artists] = np.inf
+        add(candidates.beating(all_artists, venues.positions(changed_venues), thresholds, axis=0))
+
+    upsert(found, now)
+    artist_ids = rerank_artists | {artist_id for artist_id, _ in found}
+    venue_ids = rerank_venues | {venue_id for _, venue_id in found}
+    if incremental:
+        trim(artist_ids, venue_ids)
+    set_refreshed_at(connection, now)
+    db.session.commit()
+    return artist_ids, venue_ids
+
+@jobs.job('refresh-matches')
+def refresh_job():
+    artist_ids, venue_ids = refresh()
+    cache.invalidate(*[f'artist:{id}' for id in artist_ids], *[f'venue:{id}' for id in venue_ids])
+
+def refresh_later():
+    if np is not None:
+        jobs.enqueue('refresh-matches', key='refresh-matches',
+                     delay=app.config['MATCHES_REFRESH_DELAY'])
@@ -0,0 +1,63 @@
+"""initial schema
+
+Revision ID: 3f1c9a2b7d10
+Revises: 
+Create Date: 2026-10-18 09:12:44.182031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a2b7d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('artists',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('genres', sa.ARRAY(sa.String()), nullable=False),
+    sa.Column('city', sa.String(length=120), nullable=True),
+    sa.Column('state', sa.String(length=120), nullable=True),
+    sa.Column('phone', sa.String(length=120), nullable=True),
+    sa.Column('website', sa.String(length=500), nullable=True),
+    sa.Column('facebook_link', sa.String(length=500), nullable=True),
+    sa.Column('seeking_venue', sa.Boolean(), nullable=False),
+    sa.Column('seeking_description', sa.String(), nullable=True),
+    sa.Column('image_link', sa.String(length=500), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('venues',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('genres', sa.ARRAY(sa.String()), nullable=False),
+    sa.Column('address', sa.String(length=120), nullable=True),
+    sa.Column('city', sa.String(length=120), nullable=True),
+    sa.Column('state', sa.String(length=120), nullable=True),
+    sa.Column('phone', sa.String(length=120), nullable=True),
+    sa.Column('website', sa.String(length=500), nullable=True),
+    sa.Column('facebook_link', sa.String(length=500), nullable=True),
+    sa.Column('seeking_talent', sa.Boolean(), nullable=False),
+    sa.Column('seeking_description', sa.String(), nullable=True),
+    sa.Column('image_link', sa.String(length=500), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('shows',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('venue_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['artists.id'], ),
+    sa.ForeignKeyConstraint(['venue_id'], ['venues.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('shows')
+    op.drop_table('venues')
+    op.drop_table('artists')
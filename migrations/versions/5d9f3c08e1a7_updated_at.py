@@ -0,0 +1,28 @@
+"""updated_at timestamps on venues, artists and shows
+
+Revision ID: 5d9f3c08e1a7
+Revises: c27a91e4f5b8
+Create Date: 2026-10-18 12:41:52.207386
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d9f3c08e1a7'
+down_revision = 'c27a91e4f5b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows count as modified now; new values come from the models
+    for table in ('venues', 'artists', 'shows'):
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=False,
+                                       server_default=sa.func.now()))
+
+
+def downgrade():
+    for table in ('shows', 'artists', 'venues'):
+        op.drop_column(table, 'updated_at')
@@ -0,0 +1,39 @@
+"""suggested artist-venue matches
+
+Revision ID: a81f6c3d5e92
+Revises: e4a7b19c2d63
+Create Date: 2026-10-18 17:48:36.104522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a81f6c3d5e92'
+down_revision = 'e4a7b19c2d63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by `flask refresh-matches`
+    op.create_table('matches',
+                    sa.Column('artist_id', sa.Integer(), nullable=False),
+                    sa.Column('venue_id', sa.Integer(), nullable=False),
+                    sa.Column('score', sa.Float(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['artist_id'], ['artists.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['venue_id'], ['venues.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('artist_id', 'venue_id'))
+    op.create_index('ix_matches_venue_id', 'matches', ['venue_id'])
+    op.create_table('match_state',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('match_state')
+    op.drop_index('ix_matches_venue_id', table_name='matches')
+    op.drop_table('matches')
@@ -0,0 +1,44 @@
+"""shows deleted with their venue or artist, soft-deleted venues and artists
+
+Revision ID: b5e83d2c7f14
+Revises: a81f6c3d5e92
+Create Date: 2026-10-18 18:02:47.215830
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e83d2c7f14'
+down_revision = 'a81f6c3d5e92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for column, table in (('venue_id', 'venues'), ('artist_id', 'artists')):
+        op.drop_constraint(f'shows_{column}_fkey', 'shows', type_='foreignkey')
+        op.create_foreign_key(f'shows_{column}_fkey', 'shows', table, [column], ['id'],
+                              ondelete='CASCADE')
+        op.add_column(table, sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    # the listing indexes only cover rows that are not deleted
+    op.drop_index('ix_venues_city_state', table_name='venues')
+    op.create_index('ix_venues_city_state', 'venues', ['city', 'state'],
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+    op.drop_index('ix_artists_name_id', table_name='artists')
+    op.create_index('ix_artists_name_id', 'artists', ['name', 'id'],
+                    postgresql_where=sa.text('deleted_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_artists_name_id', table_name='artists')
+    op.create_index('ix_artists_name_id', 'artists', ['name', 'id'])
+    op.drop_index('ix_venues_city_state', table_name='venues')
+    op.create_index('ix_venues_city_state', 'venues', ['city', 'state'])
+
+    for column, table in (('artist_id', 'artists'), ('venue_id', 'venues')):
+        op.drop_column(table, 'deleted_at')
+        op.drop_constraint(f'shows_{column}_fkey', 'shows', type_='foreignkey')
+        op.create_foreign_key(f'shows_{column}_fkey', 'shows', table, [column], ['id'])
@@ -0,0 +1,36 @@
+"""indexes for show lookups, venue areas and genres
+
+Revision ID: c27a91e4f5b8
+Revises: 8b4e2d6f0a35
+Create Date: 2026-10-18 11:26:05.913374
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c27a91e4f5b8'
+down_revision = '8b4e2d6f0a35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_shows_venue_id_start_time', 'shows', ['venue_id', 'start_time'])
+    op.create_index('ix_shows_artist_id_start_time', 'shows', ['artist_id', 'start_time'])
+    op.create_index('ix_shows_start_time_id', 'shows', ['start_time', 'id'])
+    op.create_index('ix_venues_city_state', 'venues', ['city', 'state'])
+    op.create_index('ix_artists_name_id', 'artists', ['name', 'id'])
+    op.create_index('ix_venues_genres', 'venues', ['genres'], postgresql_using='gin')
+    op.create_index('ix_artists_genres', 'artists', ['genres'], postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_artists_genres', table_name='artists')
+    op.drop_index('ix_venues_genres', table_name='venues')
+    op.drop_index('ix_artists_name_id', table_name='artists')
+    op.drop_index('ix_venues_city_state', table_name='venues')
+    op.drop_index('ix_shows_start_time_id', table_name='shows')
+    op.drop_index('ix_shows_artist_id_start_time', table_name='shows')
+    op.drop_index('ix_shows_venue_id_start_time', table_name='shows')
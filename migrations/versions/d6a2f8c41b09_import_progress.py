@@ -0,0 +1,28 @@
+"""import progress, saved with each batch
+
+Revision ID: d6a2f8c41b09
+Revises: b5e83d2c7f14
+Create Date: 2026-10-18 19:12:05.481377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6a2f8c41b09'
+down_revision = 'b5e83d2c7f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # written by `flask import-data`
+    op.create_table('import_progress',
+                    sa.Column('path', sa.String(), nullable=False),
+                    sa.Column('rows', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('path'))
+
+
+def downgrade():
+    op.drop_table('import_progress')
@@ -0,0 +1,49 @@
+"""upcoming and past show counters on venues and artists
+
+Revision ID: e4a7b19c2d63
+Revises: 5d9f3c08e1a7
+Create Date: 2026-10-18 17:32:10.482915
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7b19c2d63'
+down_revision = '5d9f3c08e1a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('venues', 'artists'):
+        op.add_column(table, sa.Column('num_upcoming_shows', sa.Integer(), nullable=False,
+                                       server_default='0'))
+        op.add_column(table, sa.Column('num_past_shows', sa.Integer(), nullable=False,
+                                       server_default='0'))
+    op.create_table('show_counter_state',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('rolled_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+
+    # count the existing shows; `flask roll-show-counters` takes over from here
+    now = datetime.now()
+    for table, owner in (('venues', 'venue_id'), ('artists', 'artist_id')):
+        op.execute(sa.text(
+            f'UPDATE {table} SET '
+            f'num_upcoming_shows = (SELECT count(*) FROM shows '
+            f'WHERE shows.{owner} = {table}.id AND shows.start_time > :now), '
+            f'num_past_shows = (SELECT count(*) FROM shows '
+            f'WHERE shows.{owner} = {table}.id AND shows.start_time <= :now)'
+        ).bindparams(now=now))
+    op.execute(sa.text('INSERT INTO show_counter_state (id, rolled_at) VALUES (1, :now)')
+               .bindparams(now=now))
+
+
+def downgrade():
+    op.drop_table('show_counter_state')
+    for table in ('artists', 'venues'):
+        op.drop_column(table, 'num_past_shows')
+        op.drop_column(table, 'num_upcoming_shows')
@@ -1,15 +1,59 @@
+import sqlite3
+from datetime import datetime
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
 from app import db
 
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
 
+# genres are a PostgreSQL array; SQLite, used for local development and
+# benchmarks, stores them as JSON
+GENRES_TYPE = db.ARRAY(db.String).with_variant(db.JSON(), 'sqlite')
+
+@event.listens_for(Engine, 'connect')
+def enforce_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys, and so cascades deletes, when asked
+    # to on each connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+# the in-process indexes kept in step with ORM writes (search.py,
+# discovery.py) take a change in once the transaction making it commits,
+# and never if it rolls back
+def after_commit(target, change):
+    orm.object_session(target).info.setdefault('after_commit', []).append(change)
+
+@event.listens_for(orm.Session, 'after_commit')
+def run_after_commit(session):
+    for change in session.info.pop('after_commit', ()):
+        change()
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def drop_after_commit(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('after_commit', None)
+
 class Venue(db.Model):
     __tablename__ = 'venues'
+    __table_args__ = (
+        # trigram index backing name search, see search.py
+        db.Index('ix_venues_name_trgm', 'name',
+                 postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}),
+        # only rows that are not deleted, like every query, see deletion.py
+        db.Index('ix_venues_city_state', 'city', 'state',
+                 postgresql_where=db.text('deleted_at IS NULL'),
+                 sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_venues_genres', 'genres', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    genres = db.Column(db.ARRAY(db.String), nullable=False)
+    genres = db.Column(GENRES_TYPE, nullable=False)
     address = db.Column(db.String(120))    
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
@@ -19,21 +63,41 @@ class Venue(db.Model):
     seeking_talent = db.Column(db.Boolean, nullable=False, default=False)    
     seeking_description = db.Column(db.String)    
     image_link = db.Column(db.String(500))    
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+    # maintained by counters.py
+    num_upcoming_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    num_past_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # set when the venue is deleted, until it is purged; see deletion.py
+    deleted_at = db.Column(db.DateTime)
     
-    # one venue, many shows
+    # one venue, many shows; deleted by the database along with the venue
+    # rather than loaded and deleted one by one
     shows = db.relationship('Show', 
                             backref='venue', 
                             lazy=True,
-                            cascade="all, delete")
+                            cascade="all, delete",
+                            passive_deletes=True)
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
 
 class Artist(db.Model):
     __tablename__ = 'artists'
+    __table_args__ = (
+        # trigram index backing name search, see search.py
+        db.Index('ix_artists_name_trgm', 'name',
+                 postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}),
+        # keyset pagination order of the /artists listing, of the artists
+        # that are not deleted
+        db.Index('ix_artists_name_id', 'name', 'id',
+                 postgresql_where=db.text('deleted_at IS NULL'),
+                 sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_artists_genres', 'genres', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
-    genres = db.Column(db.ARRAY(db.String), nullable=False)   
+    genres = db.Column(GENRES_TYPE, nullable=False)   
     city = db.Column(db.String(120))
     state = db.Column(db.String(120))
     phone = db.Column(db.String(120))
@@ -42,12 +106,20 @@ class Artist(db.Model):
     seeking_venue = db.Column(db.Boolean, nullable=False, default=False)    
     seeking_description = db.Column(db.String)     
     image_link = db.Column(db.String(500))
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+    # maintained by counters.py
+    num_upcoming_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    num_past_shows = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # set when the artist is deleted, until it is purged; see deletion.py
+    deleted_at = db.Column(db.DateTime)
     
-    # one artist, many shows
+    # one artist, many shows; deleted by the database along with the artist
+    # rather than loaded and deleted one by one
     shows = db.relationship('Show', 
                             backref='artist', 
                             lazy=True, 
-                            cascade="all, delete")
+                            cascade="all, delete",
+                            passive_deletes=True)
     def __repr__(self):
         return f'<Artist {self.id}\n{self.name}\n{self.genres}\n{self.city}\n{self.state}\n{self.phone}\n{self.website}\n{self.facebook_link}\n{self.seeking_venue}\n{self.seeking_description}\n{self.image_link}>'   
     
@@ -56,12 +128,56 @@ class Artist(db.Model):
 # TODO Implement Show model, and complete all model relationships and properties, as a database migration.
 class Show(db.Model):
     __tablename__ = 'shows'
+    __table_args__ = (
+        # shows are almost always read per venue or per artist and split
+        # around the current time
+        db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_shows_artist_id_start_time', 'artist_id', 'start_time'),
+        # keyset pagination order of the /shows listing
+        db.Index('ix_shows_start_time_id', 'start_time', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     start_time = db.Column(db.DateTime, nullable=False)
     artist_id = db.Column(db.Integer, 
-                          db.ForeignKey('artists.id'), 
+                          db.ForeignKey('artists.id', ondelete='CASCADE'), 
                           nullable=False)
     venue_id = db.Column(db.Integer, 
-                         db.ForeignKey('venues.id'), 
+                         db.ForeignKey('venues.id', ondelete='CASCADE'), 
                          nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+class ShowCounterState(db.Model):
+    # single row: the time up to which shows have been rolled from upcoming
+    # to past in the venue and artist counters, see counters.py
+    __tablename__ = 'show_counter_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    rolled_at = db.Column(db.DateTime, nullable=False)
+
+class Match(db.Model):
+    # suggested artist-venue pairs with their score, see matching.py
+    __tablename__ = 'matches'
+    __table_args__ = (
+        db.Index('ix_matches_venue_id', 'venue_id'),
+    )
+
+    artist_id = db.Column(db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), primary_key=True)
+    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class MatchState(db.Model):
+    # single row: when the matches were last refreshed, see matching.py
+    __tablename__ = 'match_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+
+class ImportProgress(db.Model):
+    # rows of a file committed by `flask import-data`, saved in each batch's
+    # transaction for --resume, see commands.py
+    __tablename__ = 'import_progress'
+
+    path = db.Column(db.String, primary_key=True)
+    rows = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,88 @@
+import time
+import threading
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+#----------------------------------------------------------------------------#
+# Connection pool metrics.
+#----------------------------------------------------------------------------#
+
+# The engine is created with InstrumentedQueuePool, which times how long each
+# checkout waits for a free connection. Pool events count checkouts, new
+# connections and invalidations. The totals are per process and served at
+# /internal/pool.
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkouts = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.timeouts = 0
+
+    def add_wait(self, seconds):
+        with self.lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def increment(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+metrics = Metrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.increment('timeouts')
+            raise
+        finally:
+            metrics.add_wait(time.perf_counter() - start)
+
+
+@event.listens_for(InstrumentedQueuePool, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.increment('checkouts')
+
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    metrics.increment('connects')
+
+@event.listens_for(InstrumentedQueuePool, 'invalidate')
+@event.listens_for(InstrumentedQueuePool, 'soft_invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    metrics.increment('invalidations')
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    with metrics.lock:
+        stats = {
+            'checkouts': metrics.checkouts,
+            'connects': metrics.connects,
+            'invalidations': metrics.invalidations,
+            'timeouts': metrics.timeouts,
+            'wait_seconds_total': round(metrics.wait_total, 6),
+            'wait_seconds_max': round(metrics.wait_max, 6),
+            'wait_seconds_avg': round(metrics.wait_total / metrics.checkouts, 6) if metrics.checkouts else 0.0,
+        }
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        })
+    return stats
@@ -0,0 +1,163 @@
+import heapq
+import threading
+import time
+from flask import g, request, has_app_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+#----------------------------------------------------------------------------#
+# Request profiling.
+#----------------------------------------------------------------------------#
+
+# Every request is timed, along with the SQL it runs (through engine events)
+# and the template it renders (through Flask's template signals). Requests
+# slower than PROFILE_SLOW_REQUEST_MS are logged with their statements, the
+# totals are kept per route for /internal/profile, and with
+# PROFILE_SERVER_TIMING on each response carries a Server-Timing header that
+# shows the split in the browser's network panel.
+
+# statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+# slowest statements kept per route
+SLOWEST_PER_ROUTE = 5
+
+
+class RequestProfile:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statement_count = 0
+        self.db_time = 0.0
+        self.render_start = None
+        self.render_time = 0.0
+        self.statements = []
+        self.lock = threading.Lock()
+
+    def add_statement(self, statement, duration):
+        with self.lock:
+            self.statement_count += 1
+            self.db_time += duration
+            if len(self.statements) < MAX_LOGGED_STATEMENTS:
+                self.statements.append((duration, statement))
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.total_time = 0.0
+        self.max_total_time = 0.0
+        self.slowest = []
+
+    def add(self, profile, total):
+        self.requests += 1
+        self.statements += profile.statement_count
+        self.max_statements = max(self.max_statements, profile.statement_count)
+        self.db_time += profile.db_time
+        self.render_time += profile.render_time
+        self.total_time += total
+        self.max_total_time = max(self.max_total_time, total)
+        for duration, statement in profile.statements:
+            if len(self.slowest) < SLOWEST_PER_ROUTE:
+                heapq.heappush(self.slowest, (duration, statement))
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (duration, statement))
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'statements_avg': self.statements / self.requests,
+            'statements_max': self.max_statements,
+            'db_ms_avg': self.db_time / self.requests * 1000,
+            'render_ms_avg': self.render_time / self.requests * 1000,
+            'total_ms_avg': self.total_time / self.requests * 1000,
+            'total_ms_max': self.max_total_time * 1000,
+            'slowest_statements': [{'ms': duration * 1000, 'sql': statement}
+                                   for duration, statement in sorted(self.slowest, reverse=True)],
+        }
+
+
+routes = {}
+routes_lock = threading.Lock()
+
+def route_stats():
+    with routes_lock:
+        return {endpoint: stats.as_dict() for endpoint, stats in routes.items()}
+
+def current_profile():
+    # the request's profile, also in the app contexts running its parallel
+    # queries (see gather in app.py)
+    if has_app_context():
+        return g.get('profile')
+    return None
+
+#  SQL
+#  ----------------------------------------------------------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['profile_start'].pop()
+    profile = current_profile()
+    if profile is not None:
+        profile.add_statement(statement, duration)
+
+    if duration * 1000 > app.config['PROFILE_SLOW_QUERY_MS']:
+        app.logger.warning('slow query (%.1f ms): %s', duration * 1000, statement)
+
+#  Templates
+#  ----------------------------------------------------------------
+
+@before_render_template.connect_via(app)
+def on_before_render(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None:
+        profile.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def on_rendered(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile.render_start is not None:
+        profile.render_time += time.perf_counter() - profile.render_start
+        profile.render_start = None
+
+#  Requests
+#  ----------------------------------------------------------------
+
+@app.before_request
+def start_profile():
+    g.profile = RequestProfile()
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    total = time.perf_counter() - profile.start
+    endpoint = request.endpoint or 'unknown'
+
+    with routes_lock:
+        routes.setdefault(endpoint, RouteStats()).add(profile, total)
+
+    if total * 1000 > app.config['PROFILE_SLOW_REQUEST_MS']:
+        app.logger.warning(
+            'slow request %s %s (%s): %.1f ms total, %d statements in %.1f ms, render %.1f ms\n%s',
+            request.method, request.full_path, endpoint, total * 1000,
+            profile.statement_count, profile.db_time * 1000, profile.render_time * 1000,
+            '\n'.join(f'  {duration * 1000:8.1f} ms  {statement}'
+                      for duration, statement in profile.statements))
+
+    if app.config['PROFILE_SERVER_TIMING']:
+        response.headers.add('Server-Timing',
+                             f'db;dur={profile.db_time * 1000:.1f};desc="{profile.statement_count} statements", '
+                             f'render;dur={profile.render_time * 1000:.1f}, '
+                             f'app;dur={total * 1000:.1f}')
+    return response
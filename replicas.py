@@ -0,0 +1,222 @@
+import math
+import random
+import threading
+import time
+from flask import g, request, session, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, exc, text
+from sqlalchemy.sql.dml import UpdateBase
+
+#----------------------------------------------------------------------------#
+# Read replicas.
+#----------------------------------------------------------------------------#
+
+# With DATABASE_REPLICA_URLS set, GET and HEAD requests (and views marked
+# @replicas.reads, such as the search forms, which POST) read from a
+# replica; every other request, the *_submission handlers among them, runs
+# on the primary. The database is chosen once, before the view runs, and
+# kept in g.replica; RoutingSession binds the request's queries to it.
+# Flushes and INSERT, UPDATE and DELETE statements always go to the primary.
+#
+# The lag of each replica is checked in the background every
+# REPLICA_CHECK_INTERVAL seconds. On PostgreSQL it is 0 when the replica has
+# replayed the primary's WAL up to where it was at the check, and the age of
+# the last transaction it replayed otherwise. Replicas more than
+# REPLICA_MAX_LAG_SECONDS behind, and those that cannot be reached, are left
+# out until a later check finds them back; with none left, reads go to the
+# primary. A replica that drops its connections is left out at once, though
+# the request that found out fails. Other databases (e.g. two SQLite files
+# in development) have no measurable lag and count as up to date whenever
+# they answer.
+#
+# A user reads their own writes: a request that committed a write stores
+# the primary's WAL position in the session cookie, and that user's reads
+# stay on the primary until a replica has replayed past it, or for at most
+# REPLICA_MAX_LAG_SECONDS (the whole of it where positions are unknown).
+# So the redirect to show_artist after edit_artist_submission shows the
+# edit. For everyone else, pages rendered from a replica are not put in the
+# page cache for REPLICA_MAX_LAG_SECONDS after a write invalidated pages,
+# see cache.cached.
+#
+# /internal/replicas shows the state of each replica.
+
+app = None
+primary = None
+
+
+class Replica:
+
+    def __init__(self, key, engine):
+        self.key = key
+        self.engine = engine
+        # seconds behind the primary, None until checked or while unreachable
+        self.lag = None
+        # WAL position replayed, None where there is none
+        self.position = None
+        self.error = None
+
+    def check(self, primary_position):
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    recovering, replayed, age = connection.execute(text(
+                        'SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn(), '
+                        'extract(epoch FROM now() - pg_last_xact_replay_timestamp())')).one()
+                else:
+                    connection.execute(text('SELECT 1'))
+                    recovering = False
+        except exc.SQLAlchemyError as e:
+            self.lost(e)
+            return
+
+        self.error = None
+        if not recovering:
+            # not a standby, so not behind anything it could tell
+            self.lag, self.position = 0.0, None
+            return
+        self.position = parse_position(replayed)
+        if primary_position is not None and self.position >= primary_position:
+            self.lag = 0.0
+        else:
+            self.lag = float(age) if age is not None else math.inf
+
+    def lost(self, error):
+        if self.lag is not None:
+            app.logger.warning('replica %s is unreachable: %s', self.key, error)
+        self.lag = None
+        self.error = str(error).splitlines()[0]
+
+    def usable(self, written):
+        # whether the replica may serve a read, given the user's last write
+        # (None, or when and at which primary position it was committed)
+        if self.lag is None or self.lag > app.config['REPLICA_MAX_LAG_SECONDS']:
+            return False
+        if written is None:
+            return True
+        position = written[1]
+        return position is not None and self.position is not None and self.position >= position
+
+    def status(self):
+        return {'lag_seconds': self.lag, 'position': self.position, 'error': self.error}
+
+
+replicas = []
+lock = threading.Lock()
+checked_at = -math.inf
+checking = False
+
+def parse_position(lsn):
+    # a PostgreSQL WAL position, e.g. '16/B374D848', as a number
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+def primary_position(connection):
+    if connection.dialect.name != 'postgresql':
+        return None
+    return parse_position(connection.execute(text('SELECT pg_current_wal_lsn()')).scalar())
+
+#  Routing
+#  ----------------------------------------------------------------
+
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = g.get('replica') if has_app_context() else None
+        if key is None or bind is not None or self._flushing or isinstance(clause, UpdateBase):
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        return self._db.engines[key]
+
+def reads(view):
+    # for views that only read although they are not GETs
+    view.replica_reads = True
+    return view
+
+def route():
+    g.replica = None
+    if not replicas:
+        return
+    view = app.view_functions.get(request.endpoint)
+    if request.method not in ('GET', 'HEAD') and not getattr(view, 'replica_reads', False):
+        return
+    check_soon()
+
+    written = session.get('database_write')
+    if written is not None and time.time() - written[0] > app.config['REPLICA_MAX_LAG_SECONDS']:
+        written = None
+    usable = [replica for replica in replicas if replica.usable(written)]
+    if usable:
+        g.replica = random.choice(usable).key
+
+def remember_write(response):
+    if g.get('wrote') and replicas:
+        with primary.connect() as connection:
+            position = primary_position(connection)
+        session['database_write'] = [time.time(), position]
+    return response
+
+def on_flush(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+def on_execute(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['wrote'] = True
+
+def on_commit(db_session):
+    if db_session.info.pop('wrote', False) and has_request_context():
+        g.wrote = True
+
+def on_rollback(db_session):
+    db_session.info.pop('wrote', None)
+
+#  Lag checks
+#  ----------------------------------------------------------------
+
+def check_soon():
+    # starts a check in the background when the last one is too old; the
+    # requests meanwhile go by the results of the last one
+    global checking
+    with lock:
+        if checking or time.monotonic() - checked_at < app.config['REPLICA_CHECK_INTERVAL']:
+            return
+        checking = True
+    threading.Thread(target=check, daemon=True).start()
+
+def check():
+    global checked_at, checking
+    try:
+        try:
+            with primary.connect() as connection:
+                position = primary_position(connection)
+        except exc.SQLAlchemyError:
+            position = None
+        for replica in replicas:
+            replica.check(position)
+    finally:
+        checked_at = time.monotonic()
+        checking = False
+
+def status():
+    return {replica.key: replica.status() for replica in replicas}
+
+def init_app(flask_app, database):
+    global app, primary
+    app = flask_app
+    with app.app_context():
+        primary = database.engine
+        for key, engine in database.engines.items():
+            if key is not None and key.startswith('replica'):
+                replicas.append(Replica(key, engine))
+
+    for replica in replicas:
+        def on_error(context, replica=replica):
+            # dropped at once rather than at the next check
+            if context.is_disconnect:
+                replica.lost(context.original_exception)
+        event.listen(replica.engine, 'handle_error', on_error)
+
+    app.before_request(route)
+    app.after_request(remember_write)
+    event.listen(RoutingSession, 'after_flush', on_flush)
+    event.listen(RoutingSession, 'do_orm_execute', on_execute)
+    event.listen(RoutingSession, 'after_commit', on_commit)
+    event.listen(RoutingSession, 'after_rollback', on_rollback)
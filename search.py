@@ -0,0 +1,150 @@
+import threading
+from collections import defaultdict
+from sqlalchemy import event
+from app import db
+from models import Venue, Artist, after_commit
+
+#----------------------------------------------------------------------------#
+# Name search.
+#----------------------------------------------------------------------------#
+
+# On PostgreSQL name search is served by the pg_trgm GIN indexes created in
+# the trigram migration: the case-insensitive substring match is an index
+# scan and results are ranked by trigram similarity to the search term.
+#
+# Other backends (SQLite during development) have no trigram support, so an
+# in-process trigram index with the same matching and ranking rules is kept
+# per searchable column instead. It is built on first use and then kept in
+# step with inserts, updates and deletes made through the ORM, as they
+# commit.
+
+def trigrams(text):
+    # padded like pg_trgm so that word boundaries take part in ranking
+    text = '  ' + (text or '').lower() + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class TrigramIndex:
+
+    def __init__(self, column):
+        self.column = column
+        self.model = column.class_
+        self.names = None
+        self.postings = None
+        # request threads write to the index while others search it
+        self.lock = threading.RLock()
+
+    def build(self):
+        self.names = {}
+        self.postings = defaultdict(set)
+        for id, name in db.session.query(self.model.id, self.column):
+            self.add(id, name)
+
+    def add(self, id, name):
+        with self.lock:
+            if self.names is None:
+                return
+            self.discard(id)
+            self.names[id] = name or ''
+            for gram in trigrams(name):
+                self.postings[gram].add(id)
+
+    def discard(self, id):
+        with self.lock:
+            if self.names is None:
+                return
+            name = self.names.pop(id, None)
+            if name is None:
+                return
+            for gram in trigrams(name):
+                self.postings[gram].discard(id)
+
+    def search(self, term, limit):
+        with self.lock:
+            if self.names is None:
+                self.build()
+            return self.matches(term, limit)
+
+    def matches(self, term, limit):
+        # every unpadded trigram of the term must occur in a matching name,
+        # so intersecting their postings narrows the candidates before the
+        # substring check; terms shorter than a trigram check every name
+        needle = term.lower()
+        grams = [needle[i:i + 3] for i in range(len(needle) - 2)]
+        if grams:
+            candidates = set.intersection(*(self.postings.get(gram, set())
+                                            for gram in grams))
+        else:
+            candidates = self.names.keys()
+
+        term_grams = trigrams(term)
+        hits = [(id, self.names[id]) for id in candidates
+                if needle in self.names[id].lower()]
+        hits.sort(key=lambda hit: (-similarity(term_grams, trigrams(hit[1])), hit[1]))
+        return hits[:limit]
+
+    def reset(self):
+        # rebuilt on the next search
+        with self.lock:
+            self.names = None
+            self.postings = None
+
+    def listen(self):
+        # keep the index in step with ORM writes once it has been built
+        def on_write(mapper, connection, target):
+            if self.names is None:
+                return
+            id = target.id
+            if target.deleted_at is not None:
+                # soft deleted, see deletion.py
+                after_commit(target, lambda: self.discard(id))
+            else:
+                name = getattr(target, self.column.key)
+                after_commit(target, lambda: self.add(id, name))
+
+        def on_delete(mapper, connection, target):
+            if self.names is not None:
+                id = target.id
+                after_commit(target, lambda: self.discard(id))
+
+        event.listen(self.model, 'after_insert', on_write)
+        event.listen(self.model, 'after_update', on_write)
+        event.listen(self.model, 'after_delete', on_delete)
+        return self
+
+
+fallback_indexes = {
+    Venue: TrigramIndex(Venue.name).listen(),
+    Artist: TrigramIndex(Artist.name).listen(),
+}
+
+def reset():
+    # for writes that bypass the ORM events, e.g. bulk imports
+    for index in fallback_indexes.values():
+        index.reset()
+
+def search_names(model, term, limit):
+    # returns up to limit (id, name) pairs whose name contains term, best
+    # match first
+    if db.engine.dialect.name != 'postgresql':
+        return fallback_indexes[model].search(term, limit)
+
+    return db.session.query(model.id, model.name) \
+        .filter(model.name.ilike(f'%{escape_like(term)}%', escape='\\')) \
+        .order_by(db.func.similarity(model.name, term).desc(), model.name) \
+        .limit(limit) \
+        .all()
+
+def venues(term, limit):
+    return search_names(Venue, term, limit)
+
+def artists(term, limit):
+    return search_names(Artist, term, limit)
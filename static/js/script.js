@@ -2,3 +2,32 @@ window.parseISOString = function parseISOString(s) {
   var b = s.split(/\D+/);
   return new Date(Date.UTC(b[0], --b[1], b[2], b[3], b[4], b[5], b[6]));
 };
+
+// "Load more" on the venue and artist pages: fetch the next batch of past
+// shows and put it in place of the link.
+document.addEventListener('click', function(event) {
+  var link = event.target.closest && event.target.closest('.load-more a');
+  if (!link) return;
+  event.preventDefault();
+  fetch(link.href)
+    .then(function(response) { return response.text(); })
+    .then(function(html) { link.parentNode.outerHTML = html; });
+});
+
+// Delete on the venue and artist pages: send the DELETE and, once it went
+// through, go to the home page, which flashes the outcome; otherwise say so
+// and let the user try again.
+document.addEventListener('click', function(event) {
+  var button = event.target.closest && event.target.closest('[data-delete]');
+  if (!button || !window.confirm('Delete ' + button.dataset.name + '?')) return;
+  button.disabled = true;
+  fetch(button.dataset.delete, {method: 'DELETE'})
+    .then(function(response) {
+      if (!response.ok) throw new Error(response.status);
+      window.location = '/';
+    })
+    .catch(function() {
+      button.disabled = false;
+      window.alert(button.dataset.name + ' could not be deleted. Please try again.');
+    });
+});
@@ -0,0 +1,54 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+# the app reads its configuration on import; run it on a throwaway SQLite
+# database, with jobs run in the request and no cached pages shared
+# between tests
+database = os.path.join(tempfile.mkdtemp(), 'fyyur.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+os.environ['JOB_BACKEND'] = 'sync'
+
+from app import app as flask_app, db
+from models import Venue, Artist, Show
+import cache
+
+ARTIST_FORM = {
+    'name': 'Band',
+    'genres': ['Jazz'],
+    'city': 'San Francisco',
+    'state': 'CA',
+    'phone': '326-123-5000',
+    'image_link': '',
+    'facebook_link': 'https://www.facebook.com/band',
+    'website_link': 'https://band.example.com',
+    'seeking_description': '',
+}
+
+@pytest.fixture
+def app():
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        venue = Venue(name='The Hall', genres=['Jazz'], city='San Francisco', state='CA',
+                      address='1 Market St')
+        artist = Artist(**{key: value for key, value in ARTIST_FORM.items()
+                           if key not in ('website_link', 'seeking_description')},
+                        website=ARTIST_FORM['website_link'])
+        db.session.add_all([venue, artist])
+        db.session.flush()
+        db.session.add(Show(venue_id=venue.id, artist_id=artist.id,
+                            start_time=datetime.now() + timedelta(days=7)))
+        db.session.commit()
+        cache.clear()
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
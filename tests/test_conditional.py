@@ -0,0 +1,25 @@
+from conftest import ARTIST_FORM
+
+def test_unchanged_page_is_not_sent_again(client):
+    etag = client.get('/artists/1').headers['ETag']
+
+    response = client.get('/artists/1', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+
+def test_flashed_message_is_shown_after_unchanged_edit(client):
+    etag = client.get('/artists/1').headers['ETag']
+
+    # nothing changes, so neither does the page's ETag
+    response = client.post('/artists/1/edit', data=ARTIST_FORM)
+    assert response.status_code == 302
+    response = client.get(response.headers['Location'], headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert b'Artist *Band* was successfully updated!' in response.data
+    with client.session_transaction() as session:
+        assert '_flashes' not in session
+
+    # with the message shown, the page can be revalidated again
+    response = client.get('/artists/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
@@ -0,0 +1,24 @@
+from app import db
+from models import Venue
+import discovery
+
+def test_rebuild_keeps_the_changes_committed_while_it_ran(app, monkeypatch):
+    index = discovery.indexes[Venue]
+    with app.app_context():
+        index.reset()
+        assert discovery.facets(Venue, genres=['Jazz'])[0] == 1
+
+        build = index.build
+        def build_then_write():
+            data = build()
+            db.session.add(Venue(name='The Club', genres=['Jazz'], city='Oakland', state='CA',
+                                 address='2 Broadway'))
+            db.session.get(Venue, 1).genres = ['Folk']
+            db.session.commit()
+            return data
+        monkeypatch.setattr(index, 'build', build_then_write)
+        index.rebuild()
+
+        assert discovery.facets(Venue, genres=['Jazz'])[0] == 1
+        assert discovery.facets(Venue, genres=['Folk'])[0] == 1
+        assert discovery.facets(Venue, city='Oakland')[0] == 1
@@ -0,0 +1,26 @@
+import json
+
+from app import db
+from models import Show
+
+def write_shows(path, start_times):
+    with open(path, 'w') as file:
+        for start_time in start_times:
+            file.write(json.dumps({'venue_id': 1, 'artist_id': 1, 'start_time': start_time}) + '\n')
+
+def test_resume_after_a_failed_batch(app, tmp_path):
+    path = str(tmp_path / 'shows.jsonl')
+    runner = app.test_cli_runner()
+    write_shows(path, ['2030-01-01T20:00:00', '2030-01-02T20:00:00', 'not a time'])
+
+    result = runner.invoke(args=['import-data', 'shows', path, '--batch-size', '2'])
+    assert result.exit_code != 0
+
+    write_shows(path, ['2030-01-01T20:00:00', '2030-01-02T20:00:00', '2030-01-03T20:00:00'])
+    result = runner.invoke(args=['import-data', 'shows', path, '--batch-size', '2', '--resume'])
+    assert result.exit_code == 0, result.output
+    assert 'resuming after 2 rows' in result.output
+
+    with app.app_context():
+        # the one show listed by the fixture and the three of the file
+        assert db.session.query(Show).count() == 4
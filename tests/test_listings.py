@@ -0,0 +1,11 @@
+import pytest
+
+@pytest.mark.parametrize('path', ['/venues', '/artists', '/shows'])
+def test_flashed_message_is_shown_once(client, path):
+    with client.session_transaction() as session:
+        session['_flashes'] = [('message', 'Venue *The Hall* was successfully listed!')]
+
+    assert b'successfully listed' in client.get(path).data
+    with client.session_transaction() as session:
+        assert '_flashes' not in session
+    assert b'successfully listed' not in client.get(path).data
@@ -0,0 +1,21 @@
+from datetime import datetime, timedelta
+
+from app import db
+from models import Artist
+import matching
+
+def test_refresh_finds_writes_committed_after_the_previous_one_read(app):
+    with app.app_context():
+        first = datetime.now()
+        matching.refresh(full=True, now=first)
+
+        # stamped at its flush, before the refresh above, but committed after
+        db.session.execute(db.update(Artist)
+                           .where(Artist.id == 1)
+                           .values(genres=['Folk'], updated_at=first - timedelta(seconds=1))
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+
+        artist_ids, _ = matching.refresh(now=first + timedelta(seconds=5))
+
+        assert 1 in artist_ids
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+import pytest
+
+from app import db, encode_cursor
+from models import Venue, Artist
+
+CURSOR = encode_cursor([datetime.now(), 1])
+
+@pytest.mark.parametrize('kind', ['venues', 'artists'])
+def test_past_shows_of_a_listed_one(client, kind):
+    assert client.get(f'/{kind}/1/past_shows?before={CURSOR}').status_code == 200
+
+@pytest.mark.parametrize('kind', ['venues', 'artists'])
+@pytest.mark.parametrize('query', [f'?before={CURSOR}', ''], ids=['cursor', 'first'])
+def test_past_shows_of_an_unknown_one(client, kind, query):
+    assert client.get(f'/{kind}/9999/past_shows{query}').status_code == 404
+
+@pytest.mark.parametrize('kind, model', [('venues', Venue), ('artists', Artist)])
+def test_past_shows_of_a_deleted_one(app, client, kind, model):
+    with app.app_context():
+        db.session.get(model, 1).deleted_at = datetime.now()
+        db.session.commit()
+
+    assert client.get(f'/{kind}/1/past_shows?before={CURSOR}').status_code == 404